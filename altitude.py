@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+import math, time, numpy
+from threading import Lock
+
+# ICAO standard atmosphere layers up to 71 km: base geopotential height (m),
+# base temperature (K), lapse rate (K/m) and base pressure (hPa)
+ISA_LAYERS = (
+    (0.0, 288.15, -0.0065, 1013.25),
+    (11000.0, 216.65, 0.0, 226.3206),
+    (20000.0, 216.65, 0.001, 54.74889),
+    (32000.0, 228.65, 0.0028, 8.680187),
+    (47000.0, 270.65, 0.0, 1.109063),
+    (51000.0, 270.65, -0.0028, 0.6693887),
+    (71000.0, 214.65, -0.002, 0.03956420),
+)
+GAS_CONSTANT = 287.053 # J/(kg K), dry air
+STANDARD_GRAVITY = 9.80665
+EARTH_RADIUS = 6356766.0 # m, as used by the standard atmosphere
+
+def pressureAltitude(pressure, seaLevelPressure=1013.25):
+    # altitude (m) in the multi-layer standard atmosphere, pressure in hPa. The
+    # single-layer formula is only valid in the troposphere and is several km
+    # off by 30 km.
+    if pressure <= 0:
+        return None
+    pressure *= 1013.25 / seaLevelPressure
+    for (base, temperature, lapse, basePressure) in reversed(ISA_LAYERS):
+        if pressure <= basePressure or base == 0.0:
+            break
+    if lapse == 0.0:
+        height = base - GAS_CONSTANT * temperature / STANDARD_GRAVITY * math.log(pressure / basePressure)
+    else:
+        height = base + temperature / lapse * (math.pow(pressure / basePressure, -GAS_CONSTANT * lapse / STANDARD_GRAVITY) - 1.0)
+    # geopotential to geometric height
+    return EARTH_RADIUS * height / (EARTH_RADIUS - height)
+
+class AltitudeFilter:
+    '''Kalman filter fusing barometric and GNSS altitude
+
+    The state is altitude (m), vertical rate (m/s, positive up) and the offset
+    of the barometric altitude from the GNSS altitude. The offset absorbs the
+    unknown sea level pressure and the difference between the real atmosphere
+    and the standard one, so barometric samples give responsiveness and GNSS samples keep the
+    result anchored to MSL. Each sample costs a constant amount of work.
+    '''
+    def __init__(self, accelNoise=2.0, baroNoise=2.0, gnssNoise=8.0, velocityNoise=0.5, offsetDrift=0.05):
+        self.accelNoise = accelNoise
+        self.baroNoise = baroNoise
+        self.gnssNoise = gnssNoise
+        self.velocityNoise = velocityNoise
+        self.offsetDrift = offsetDrift
+        self.x = None
+        self.P = None
+        self.lastTime = None
+        self.lock = Lock()
+
+    @property
+    def initialised(self):
+        return self.x is not None
+
+    @property
+    def altitude(self):
+        x = self.x
+        return float(x[0]) if x is not None else 0.0
+
+    @property
+    def verticalRate(self):
+        x = self.x
+        return float(x[1]) if x is not None else 0.0
+
+    def _initialise(self, altitude, offset, offsetVariance, t):
+        self.x = numpy.array([altitude, 0.0, offset])
+        self.P = numpy.diag([100.0, 25.0, offsetVariance])
+        self.lastTime = t
+
+    def _predict(self, t):
+        dt = t - self.lastTime
+        if dt <= 0:
+            return
+        self.lastTime = t
+        F = numpy.array([[1.0, dt, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]])
+        q = self.accelNoise ** 2
+        Q = numpy.array([[q * dt**4 / 4, q * dt**3 / 2, 0.0],
+                         [q * dt**3 / 2, q * dt**2, 0.0],
+                         [0.0, 0.0, self.offsetDrift ** 2 * dt]])
+        self.x = F @ self.x
+        self.P = F @ self.P @ F.T + Q
+
+    def _update(self, z, H, r):
+        # scalar measurement z = H.x + noise with variance r
+        H = numpy.asarray(H, dtype=float)
+        PHt = self.P @ H
+        s = H @ PHt + r
+        K = PHt / s
+        x = self.x + K * (z - H @ self.x)
+        self.P = self.P - numpy.outer(K, PHt)
+        self.x = x
+
+    def addPressure(self, pressure, t=None):
+        baroAltitude = pressureAltitude(pressure)
+        if baroAltitude is None:
+            return
+        t = time.monotonic() if t is None else t
+        with self.lock:
+            if self.x is None:
+                # no GNSS yet, trust the barometer until the offset can be estimated
+                self._initialise(baroAltitude, 0.0, 1e4, t)
+                return
+            self._predict(t)
+            self._update(baroAltitude, (1.0, 0.0, 1.0), self.baroNoise ** 2)
+
+    def addGnss(self, altitude, velocityDown=None, t=None):
+        t = time.monotonic() if t is None else t
+        with self.lock:
+            if self.x is None:
+                self._initialise(altitude, 0.0, 1e4, t)
+                return
+            self._predict(t)
+            self._update(altitude, (1.0, 0.0, 0.0), self.gnssNoise ** 2)
+            if velocityDown is not None:
+                self._update(-velocityDown, (0.0, 1.0, 0.0), self.velocityNoise ** 2)
+
+    def state(self):
+        with self.lock:
+            return (self.altitude, self.verticalRate)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+'''
+Simulated-loss benchmark: erasure coded image transfer against ARQ
+
+Sends one image over a simulated link with bursty loss (Gilbert-Elliott
+channel, used for both the frames and the uplink acks) and reports the time
+until the ground station holds the complete image. ARQ sends offset chunks
+through TransmitQueue with per-frame acks and the adaptive retry timeout;
+range NACKs are not modelled. The fountain mode sends k source symbols plus
+the configured overhead, tops up with repair symbols like LoraModule does and
+stops once the decoded report reaches the payload.
+Run from the repository root: python3 benchmarks/fec_vs_arq.py [image bytes]
+'''
+
+import os, sys, math, random, struct, tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from txqueue import *
+from fountain import *
+from loraframe import *
+
+CHUNK_HEADER = struct.Struct('>BHH')
+SYMBOL_SIZE = MAX_PACKET_SIZE - RECORD_HEADER_SIZE - SYMBOL_HEADER.size
+FRAME_TIME = 0.5 # transmit delay plus airtime of a full frame
+ACK_DELAY = 0.2 # from the end of a frame until its ack has arrived
+SEEDS = 5
+LOSSES = [0.0, 0.05, 0.1, 0.2, 0.3]
+BURST = 3.0
+OVERHEADS = [0.1, 0.25, 0.5]
+
+class Channel:
+    '''Gilbert-Elliott channel, everything is lost in the bad state'''
+    def __init__(self, loss, burst, rng):
+        self.rng = rng
+        self.toGood = 1.0 / burst
+        self.toBad = loss * self.toGood / (1.0 - loss) if loss > 0 else 0.0
+        self.bad = False
+
+    def lost(self):
+        if self.bad:
+            self.bad = self.rng.random() >= self.toGood
+        else:
+            self.bad = self.rng.random() < self.toBad
+        return self.bad
+
+def newQueue(name, unreliable=()):
+    # a fresh database per run, so nothing is reloaded from the previous one
+    return TransmitQueue(os.path.join(tempfile.mkdtemp(), name), archivePath=None, unreliable=unreliable)
+
+def runArq(data, channel):
+    queue = newQueue('arq.db')
+    chunkSize = MAX_PACKET_SIZE - RECORD_HEADER_SIZE - CHUNK_HEADER.size
+    queue.enqueue([(CHUNK_HEADER.pack(0, offset, len(data)) + data[offset:offset+chunkSize], RECORD_CHUNK) for offset in range(0, len(data), chunkSize)])
+    received = set()
+    total = queue.count(RECORD_CHUNK)
+    t = 0.0
+    frames = 0
+    while len(received) < total:
+        records = queue.take(MAX_PACKET_SIZE, overhead=RECORD_HEADER_SIZE, now=t)
+        if records:
+            frames += 1
+            if not channel.lost():
+                received.update(CHUNK_HEADER.unpack_from(r.data)[1] for r in records)
+                if not channel.lost():
+                    queue.ackMany([r.wireId for r in records], now=t + ACK_DELAY)
+        t += FRAME_TIME
+    queue.close()
+    return (t, frames)
+
+def runFec(data, channel, overhead, transferId):
+    queue = newQueue('fec.db', unreliable=(RECORD_FEC,))
+    encoder = FountainEncoder(data, transferId, SYMBOL_SIZE)
+    queue.enqueue([(s, RECORD_FEC) for s in encoder.symbols(encoder.k + int(math.ceil(encoder.k * overhead)))])
+    decoder = FountainDecoder()
+    t = 0.0
+    frames = 0
+    completed = None
+    while True:
+        if queue.count(RECORD_FEC) == 0:
+            queue.enqueue([(s, RECORD_FEC) for s in encoder.symbols(int(math.ceil(encoder.k * TOPUP_FRACTION)))])
+        records = queue.take(MAX_PACKET_SIZE, overhead=RECORD_HEADER_SIZE, now=t)
+        frames += 1
+        t += FRAME_TIME
+        if not channel.lost():
+            if decoder.addSymbol(records[0].data):
+                completed = t if completed is None else completed
+                if not channel.lost():
+                    break
+    queue.close()
+    return (completed, frames)
+
+def main(size):
+    print("image %d bytes, frame time %.2fs, mean burst %.0f frames, %d runs each" % (size, FRAME_TIME, BURST, SEEDS))
+    print("%6s %16s" % ("loss", "ARQ") + "".join("%16s" % ("FEC +%d%%" % (100 * o)) for o in OVERHEADS))
+    for loss in LOSSES:
+        results = []
+        runs = [('arq', None)] + [('fec', o) for o in OVERHEADS]
+        for (mode, overhead) in runs:
+            times = []
+            frames = []
+            for seed in range(SEEDS):
+                rng = random.Random(seed)
+                data = bytes(rng.getrandbits(8) for i in range(size))
+                channel = Channel(loss, BURST, rng)
+                if mode == 'arq':
+                    (t, n) = runArq(data, channel)
+                else:
+                    (t, n) = runFec(data, channel, overhead, seed)
+                times.append(t)
+                frames.append(n)
+            results.append("%9.0fs %5d" % (sum(times) / SEEDS, sum(frames) / SEEDS))
+        print("%5.0f%% " % (100 * loss) + "".join("%16s" % r for r in results))
+    print("columns: mean seconds until the image is complete, mean frames sent")
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+'''
+Benchmark for the transmit tick against a data.db that grows over a flight
+
+Simulates several hours of telemetry and image chunks, one tick per second:
+each tick takes a frame's worth of records from TransmitQueue, acks them and
+runs the periodic flush and maintenance steps. The queue keeps its default
+retention window, measured on the simulated clock: datetime() on its
+database connection is replaced by one that reads the simulated time, so
+acked rows expire as they would in flight. For comparison the original
+per-tick SELECT is timed against a table without indexes or retention that
+receives the same rows. Reports tick latency and database size per simulated
+hour. Run from the repository root: python3 benchmarks/txqueue_tick.py [hours]
+'''
+
+import os, sys, time, sqlite3, tempfile, datetime
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from txqueue import *
+
+TELEMETRY_INTERVAL = 5
+IMAGE_INTERVAL = 300
+IMAGE_CHUNKS = 200
+FRAME_SPACE = 58
+FLUSH_TICKS = 1
+MAINTENANCE_TICKS = 30
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def simulatedDatetime(clock):
+    # stands in for SQLite's datetime(), as far as the queue uses it
+    start = datetime.datetime(2000, 1, 1)
+    def now(value, *modifiers):
+        t = start + datetime.timedelta(seconds=clock[0]) if value == 'now' else datetime.datetime.fromisoformat(value)
+        for modifier in modifiers:
+            (amount, unit) = modifier.split()
+            t += datetime.timedelta(**{unit: int(amount)})
+        return t.strftime('%Y-%m-%d %H:%M:%S')
+    return now
+
+def legacyTick(conn):
+    # the query and updates the transmit thread ran before the in-memory queue
+    rows = conn.execute("SELECT * FROM habdata WHERE ack = 0 and lasttry < Datetime('now', '-10 seconds') ORDER BY chunked ASC, created DESC LIMIT 5").fetchall()
+    for row in rows:
+        conn.execute("UPDATE habdata SET lasttry = datetime('now') WHERE id = ?", [row[0]])
+    return rows
+
+def main(hours):
+    folder = tempfile.mkdtemp()
+    path = os.path.join(folder, 'data.db')
+    clock = [0]
+    queue = TransmitQueue(path, archivePath=os.path.join(folder, 'archive.db'))
+    queue.dbConn.create_function('datetime', -1, simulatedDatetime(clock))
+    legacy = sqlite3.connect(os.path.join(folder, 'legacy.db'))
+    legacy.execute("CREATE TABLE habdata(id INTEGER PRIMARY KEY, data BLOB NOT NULL, chunked INT DEFAULT 0 NOT NULL, created timestamp NOT NULL, ack INT DEFAULT 0 NOT NULL, lasttry timestamp NOT NULL);")
+
+    print("%5s %10s %10s %10s %10s %10s %10s" % ("hour", "rows", "db KB", "tick p50", "tick p99", "old p50", "old p99"))
+    telemetry = bytes(28)
+    chunk = bytes(54)
+    for hour in range(hours):
+        ticks = []
+        legacyTicks = []
+        for second in range(3600):
+            t = hour * 3600 + second
+            clock[0] = t
+            items = []
+            if t % TELEMETRY_INTERVAL == 0:
+                items.append((telemetry, RECORD_DATA))
+            if t % IMAGE_INTERVAL == 0:
+                items.extend((chunk, RECORD_CHUNK) for i in range(IMAGE_CHUNKS))
+            if items:
+                queue.enqueue(items)
+                legacy.executemany("INSERT INTO habdata(data, chunked, created, lasttry) VALUES (?, ?, datetime('now'), datetime('now', '-1 minute'));", items)
+                legacy.commit()
+
+            start = time.perf_counter()
+            records = queue.take(FRAME_SPACE, overhead=4, now=t)
+            for record in records:
+                queue.ack(record.wireId)
+            if t % FLUSH_TICKS == 0:
+                queue.flush(force=True)
+            if t % MAINTENANCE_TICKS == 0:
+                queue.maintain(force=True)
+            ticks.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            rows = legacyTick(legacy)
+            legacy.executemany("UPDATE habdata SET ack = 1 WHERE id = ?", [(row[0],) for row in rows[:1]])
+            legacy.commit()
+            legacyTicks.append(time.perf_counter() - start)
+
+        rows = queue.dbConn.execute("SELECT COUNT(*) FROM habdata").fetchone()[0]
+        size = os.path.getsize(path) + os.path.getsize(path + '-wal')
+        print("%5d %10d %10d %9.3fms %9.3fms %9.3fms %9.3fms" % (hour + 1, rows, size // 1024,
+            1000 * percentile(ticks, 0.5), 1000 * percentile(ticks, 0.99),
+            1000 * percentile(legacyTicks, 0.5), 1000 * percentile(legacyTicks, 0.99)))
+
+    print("archived %d telemetry rows, deleted %d rows" % (queue.archived, queue.deleted))
+    queue.close()
+    legacy.close()
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 4)
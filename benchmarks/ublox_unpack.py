@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+'''
+Microbenchmark for UBloxDescriptor.unpack
+
+Builds one representative frame for every entry in ublox.msg_types (repeated
+blocks get a few records) and reports how many messages per second can be
+decoded, both by UBloxDescriptor.unpack and by the per-message parsing it
+replaced, kept below as legacy_unpack for reference.
+Run from the repository root: python3 benchmarks/ublox_unpack.py
+'''
+
+import os, sys, struct, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ublox import *
+
+RECORDS = 8
+DURATION = 0.2
+
+def zeros(fmt):
+    '''return zero values for a struct format'''
+    return list(struct.unpack(fmt, bytes(struct.calcsize(fmt))))
+
+def build_frame(msg_type, desc):
+    '''build a valid frame for a descriptor'''
+    payload = b''.join(struct.pack(fmt, *zeros(fmt)) for fmt in desc.msg_format.split(','))
+    records = 0
+    if desc.format2 is not None:
+        records = RECORDS
+        payload += struct.pack(desc.format2, *zeros(desc.format2)) * records
+    msg = UBloxMessage()
+    msg._buf = struct.pack('<BBBBH', PREAMBLE1, PREAMBLE2, msg_type[0], msg_type[1], len(payload)) + payload
+    msg._buf += struct.pack('<BB', *msg.checksum(data=msg._buf[2:]))
+    if desc.count_field not in (None, '_remaining'):
+        # patch the count field so the repeated block is decoded too
+        try:
+            desc.unpack(msg)
+        except UBloxError:
+            pass
+        msg._fields[desc.count_field] = records
+        msg._recs = [dict(zip(desc.fields2, zeros(desc.format2)))] * records
+        desc.pack(msg, msg_type[0], msg_type[1])
+    return msg._buf
+
+def legacy_unpack(desc, msg):
+    '''UBloxDescriptor.unpack before the struct plans were precompiled
+
+    Splits the format and parses array descriptors again for every message.
+    Only the '_remaining' count uses integer division, the original float
+    division could not decode those messages at all.
+    '''
+    msg._fields = {}
+
+    formats = desc.msg_format.split(',')
+    buf = msg._buf[6:-2]
+    count = 0
+    msg._recs = []
+    fields = desc.fields[:]
+
+    for fmt in formats:
+        size1 = struct.calcsize(fmt)
+        if size1 > len(buf):
+            raise UBloxError("%s INVALID_SIZE1=%u" % (desc.name, len(buf)))
+        f1 = list(struct.unpack(fmt, buf[:size1]))
+        i = 0
+        while i < len(f1):
+            field = fields.pop(0)
+            (fieldname, alen) = ArrayParse(field)
+            if alen == -1:
+                msg._fields[fieldname] = f1[i]
+                if desc.count_field == fieldname:
+                    count = int(f1[i])
+                i += 1
+            else:
+                msg._fields[fieldname] = [0]*alen
+                for a in range(alen):
+                    msg._fields[fieldname][a] = f1[i]
+                    i += 1
+        buf = buf[size1:]
+        if len(buf) == 0:
+            break
+
+    if desc.count_field == '_remaining':
+        count = len(buf) // struct.calcsize(desc.format2)
+
+    if count == 0:
+        msg._unpacked = True
+        if len(buf) != 0:
+            raise UBloxError("EXTRA_BYTES=%u" % len(buf))
+        return
+
+    size2 = struct.calcsize(desc.format2)
+    for c in range(count):
+        r = UBloxAttrDict()
+        if size2 > len(buf):
+            raise UBloxError("INVALID_SIZE=%u, " % len(buf))
+        f2 = list(struct.unpack(desc.format2, buf[:size2]))
+        for i in range(len(desc.fields2)):
+            r[desc.fields2[i]] = f2[i]
+        buf = buf[size2:]
+        msg._recs.append(r)
+    if len(buf) != 0:
+        raise UBloxError("EXTRA_BYTES=%u" % len(buf))
+    msg._unpacked = True
+
+def bench(unpack, desc, buf):
+    '''return decoded messages per second'''
+    msg = UBloxMessage()
+    msg._buf = buf
+    unpack(desc, msg)
+    n = 0
+    start = time.perf_counter()
+    while True:
+        for i in range(100):
+            unpack(desc, msg)
+        n += 100
+        elapsed = time.perf_counter() - start
+        if elapsed > DURATION:
+            return n / elapsed
+
+def rate(unpack, desc, buf):
+    '''return (messages per second or None, column text)'''
+    try:
+        r = bench(unpack, desc, buf)
+        return (r, '%.0f' % r)
+    except Exception as e:
+        return (None, 'error: %s' % str(e))
+
+if __name__ == '__main__':
+    print('%-12s %14s %14s %8s' % ('message', 'legacy msg/s', 'current msg/s', 'speedup'))
+    for (msg_type, desc) in sorted(msg_types.items(), key=lambda kv: kv[1].name):
+        try:
+            buf = build_frame(msg_type, desc)
+        except Exception as e:
+            print('%-12s error: %s' % (desc.name, str(e)))
+            continue
+        (legacy, legacyText) = rate(legacy_unpack, desc, buf)
+        (current, currentText) = rate(UBloxDescriptor.unpack, desc, buf)
+        speedup = '%7.1fx' % (current / legacy) if legacy and current else ''
+        print('%-12s %14s %14s %8s' % (desc.name, legacyText, currentText, speedup))
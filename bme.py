@@ -1,8 +1,104 @@
 #!/usr/bin/env python3
 
-import bme680, time, logging
+import bme680, time, logging, json, os, math
+import numpy
+from snapshot import Snapshot
 from threading import Thread
 
+# flight phases
+PHASE_GROUND = 0
+PHASE_ASCENT = 1
+PHASE_FLOAT = 2
+PHASE_DESCENT = 3
+
+# humidity, pressure and temperature oversampling and IIR filter size per flight phase.
+# Pressure changes quickly while ascending or descending, so those phases trade
+# oversampling and filtering for response time.
+PHASE_SETTINGS = {
+    PHASE_GROUND: (bme680.OS_2X, bme680.OS_4X, bme680.OS_8X, bme680.FILTER_SIZE_3),
+    PHASE_ASCENT: (bme680.OS_1X, bme680.OS_4X, bme680.OS_2X, bme680.FILTER_SIZE_1),
+    PHASE_FLOAT: (bme680.OS_2X, bme680.OS_16X, bme680.OS_8X, bme680.FILTER_SIZE_7),
+    PHASE_DESCENT: (bme680.OS_1X, bme680.OS_2X, bme680.OS_2X, bme680.FILTER_SIZE_0),
+}
+
+class BME680Snapshot(Snapshot):
+    __slots__ = ('sequence', 'timestamp', 'temperature', 'pressure', 'humidity', 'airQuality')
+
+class GasBaseline:
+    '''exponentially weighted baseline of heat stable gas resistance
+
+    Memory and update cost are constant however long the burn-in runs. The
+    weight of each reading follows from the time constant in seconds and the
+    interval between gas readings, so the first cold reading has decayed by
+    the end of the burn-in whatever the gas rate. The baseline can be saved to
+    disk so that a restart mid-flight resumes air quality scoring without
+    another burn-in.
+    '''
+    def __init__(self, timeConstant=60.0, interval=1.0, path="gasbaseline.json", maxAge=6 * 3600):
+        self.alpha = 1.0 - math.exp(-float(interval) / timeConstant)
+        self.value = None
+        self.samples = 0
+        self.path = path
+        self.maxAge = maxAge
+
+    def update(self, gas):
+        if self.value is None:
+            self.value = float(gas)
+        else:
+            self.value += self.alpha * (gas - self.value)
+        self.samples += 1
+        return self.value
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            if time.time() - saved["saved"] > self.maxAge or saved["value"] <= 0:
+                return False
+            self.value = float(saved["value"])
+            self.samples = int(saved["samples"])
+            return True
+        except Exception as e:
+            logging.error("Unable to load gas baseline - %s" % str(e))
+            return False
+
+    def save(self):
+        if self.path is None or self.value is None:
+            return
+        try:
+            tmpPath = self.path + ".tmp"
+            with open(tmpPath, "w") as f:
+                json.dump({"value": self.value, "samples": self.samples, "saved": time.time()}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmpPath, self.path)
+        except Exception as e:
+            logging.error("Unable to save gas baseline - %s" % str(e))
+
+class SampleRing:
+    '''fixed size numpy ring buffer of (temperature, pressure, humidity) samples'''
+    def __init__(self, size, columns=3):
+        self.data = numpy.zeros((size, columns))
+        self.index = 0
+        self.count = 0
+
+    def append(self, values):
+        self.data[self.index] = values
+        self.index = (self.index + 1) % len(self.data)
+        self.count = min(self.count + 1, len(self.data))
+
+    def clear(self):
+        self.index = 0
+        self.count = 0
+
+    def median(self):
+        return numpy.median(self.data[:self.count], axis=0)
+
+    def mean(self):
+        return numpy.mean(self.data[:self.count], axis=0)
+
 class BME680Module(Thread):
     sensor = None
     temperature = 0.0
@@ -10,22 +106,36 @@ class BME680Module(Thread):
     humidity = 0.0
     airQuality = 0
     healthy = True
-    burnInStartTime = time.time()
-    burnInDuration = 300
-    burnInData = []
+    sequence = 0
+    snapshot = BME680Snapshot(0, None, 0.0, 0.0, 0.0, 0)
+    burnInStartTime = None
+    burnInDuration = 300 # five baseline time constants
     gasBaseline = 0
     isBurnInProgress = True
+    phase = PHASE_GROUND
+    requestedPhase = PHASE_GROUND
 
-    def __init__(self):
+    def __init__(self, baselineFile="gasbaseline.json", sampleRate=4.0, gasInterval=10.0, summaryWindow=5.0, useMedian=True, altitudeFilter=None):
         logging.getLogger("HABControl")
         logging.info('Initialising BME680(Temp, Humidity and Pressure) Sensor Module')
+        self.altitudeFilter = altitudeFilter
+        self.sampleRate = sampleRate
+        self.gasInterval = gasInterval
+        self.useMedian = useMedian
+        self.summaryWindow = summaryWindow
+        self.nextSummary = time.monotonic() + summaryWindow
+        # holds one summary window, a few slots spare for timing jitter
+        self.samples = SampleRing(max(1, int(sampleRate * summaryWindow) + 2))
+        self.burnInStartTime = time.time()
+        self.baseline = GasBaseline(timeConstant=self.burnInDuration / 5.0, interval=gasInterval, path=baselineFile)
+        if self.baseline.load():
+            logging.info("Resuming with saved gas baseline %.0f" % self.baseline.value)
+            self.gasBaseline = self.baseline.value
+            self.isBurnInProgress = False
         try:
             self.sensor = bme680.BME680(bme680.I2C_ADDR_PRIMARY)
-            self.sensor.set_humidity_oversample(bme680.OS_2X)
-            self.sensor.set_pressure_oversample(bme680.OS_4X)
-            self.sensor.set_temperature_oversample(bme680.OS_8X)
-            self.sensor.set_filter(bme680.FILTER_SIZE_3)
-            self.sensor.set_gas_status(bme680.ENABLE_GAS_MEAS)
+            self.applyPhaseSettings(PHASE_GROUND)
+            self.sensor.set_gas_status(bme680.DISABLE_GAS_MEAS)
 
             self.sensor.set_gas_heater_temperature(320)
             self.sensor.set_gas_heater_duration(150)
@@ -40,27 +150,62 @@ class BME680Module(Thread):
             self.sensor = None
 
     def run(self):
+        # temperature, pressure and humidity are sampled at sampleRate, the gas
+        # heater is only fired every gasInterval seconds
+        nextSample = nextGas = time.monotonic()
         while self.healthy:
-            self.readData()
-            time.sleep(1.0)
+            if self.requestedPhase != self.phase:
+                self.applyPhaseSettings(self.requestedPhase)
+
+            now = time.monotonic()
+            readGas = now >= nextGas
+            if readGas:
+                nextGas = now + self.gasInterval
+            self.readData(readGas)
 
-    def readData(self):
+            nextSample += 1.0 / self.sampleRate
+            delay = nextSample - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                nextSample = time.monotonic()
+
+    def setFlightPhase(self, phase):
+        # applied by the sensor thread before its next sample
+        self.requestedPhase = phase
+
+    def applyPhaseSettings(self, phase):
+        (hum, pres, temp, filt) = PHASE_SETTINGS[phase]
+        self.sensor.set_humidity_oversample(hum)
+        self.sensor.set_pressure_oversample(pres)
+        self.sensor.set_temperature_oversample(temp)
+        self.sensor.set_filter(filt)
+        self.phase = phase
+        logging.info("BME680 settings for flight phase %d" % phase)
+
+    def readData(self, readGas=True):
         hum_baseline = 40.0
         hum_weighting = 0.25
         try:
-            if self.sensor.get_sensor_data():
-                self.temperature = self.sensor.data.temperature
-                self.pressure = self.sensor.data.pressure
-                self.humidity = self.sensor.data.humidity
-
-                if self.isBurnInProgress:
-                    if time.time() - self.burnInStartTime < self.burnInDuration:
-                        if self.sensor.data.heat_stable:
-                            self.burnInData.append(self.sensor.data.gas_resistance)
-                    else:
+            if readGas:
+                self.sensor.set_gas_status(bme680.ENABLE_GAS_MEAS)
+            hasData = self.sensor.get_sensor_data()
+            if readGas:
+                self.sensor.set_gas_status(bme680.DISABLE_GAS_MEAS)
+
+            if hasData:
+                self.samples.append((self.sensor.data.temperature, self.sensor.data.pressure, self.sensor.data.humidity))
+                if self.altitudeFilter is not None:
+                    self.altitudeFilter.addPressure(self.sensor.data.pressure)
+                if readGas and self.isBurnInProgress:
+                    if self.sensor.data.heat_stable:
+                        self.baseline.update(self.sensor.data.gas_resistance)
+                    # keep burning in until at least one heat stable reading arrives
+                    if time.time() - self.burnInStartTime >= self.burnInDuration and self.baseline.value:
                         self.isBurnInProgress = False
-                        self.gasBaseline = sum(self.burnInData[-50:]) / 50.0
-                elif self.sensor.data.heat_stable:
+                        self.gasBaseline = self.baseline.value
+                        self.baseline.save()
+                elif readGas and self.sensor.data.heat_stable:
                     gas = self.sensor.data.gas_resistance
                     gas_offset = self.gasBaseline - gas
 
@@ -86,6 +231,17 @@ class BME680Module(Thread):
                     # Calculate air_quality_score.
                     self.airQuality = hum_score + gas_score
 
+                # one snapshot per summary window, summarising the samples taken in it
+                now = time.monotonic()
+                if now >= self.nextSummary:
+                    self.nextSummary = max(self.nextSummary + self.summaryWindow, now)
+                    summary = self.samples.median() if self.useMedian else self.samples.mean()
+                    (self.temperature, self.pressure, self.humidity) = (float(v) for v in summary)
+                    self.samples.clear()
+                    self.sequence += 1
+                    self.snapshot = BME680Snapshot(self.sequence, now,
+                        self.temperature, self.pressure, self.humidity, self.airQuality)
+
         except Exception as e:
             logging.error("Unable to read from BME680 sensor - %s" % str(e), exc_info=True)
             self.healthy = False
@@ -93,6 +249,8 @@ class BME680Module(Thread):
             self.pressure = 0.0
             self.humidity = 0.0
             self.airQuality = 0.0
+            self.sequence += 1
+            self.snapshot = BME680Snapshot(self.sequence, time.monotonic(), 0.0, 0.0, 0.0, 0.0)
 
     def close(self):
         self.healthy = False
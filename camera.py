@@ -3,22 +3,59 @@
 import time, logging, io
 from datetime import datetime
 from picamera import PiCamera, Color
-from threading import Thread
+from threading import Thread, Lock
 from PIL import Image
+from imagetiles import encodeTiles
+from imagescore import scoreImage, hammingDistance
+from storage import StorageManager, FSYNC_BATCH
+
+THUMBNAIL_SIZE = (640, 360)
+THUMBNAIL_QUALITY = 75
+
+# rate control search space, best first
+RATE_CONTROL_SIZES = [(640, 360), (480, 270), (320, 180), (160, 90)]
+RATE_CONTROL_MIN_QUALITY = 20
+RATE_CONTROL_MAX_QUALITY = 90
+SUBSAMPLING_420 = 2
+SUBSAMPLING_444 = 0
+
+TILED_IMAGE_SIZE = (320, 180)
+
+# frames kept as downlink candidates, and the hash distance below which a frame
+# counts as a duplicate of the last one sent
+CANDIDATE_COUNT = 5
+DUPLICATE_DISTANCE = 6
+
+# seconds between burst frames that are thumbnailed and scored, the others are
+# only stored, and how long a burst frame may wait for the storage queue
+BURST_SCORE_INTERVAL = 1.0
+BURST_STORE_TIMEOUT = 1.0
 
 class CameraModule(Thread):
     camera = None
     lastSavedFile = None
+    encodeCache = (None, {})
+    lastSentHash = None
+    pendingFrame = None # returned for downlink, not yet confirmed queued
+    annotation = None
+    burstUntil = 0.0
+    burstInterval = 0.0
     healthy = True
 
-    def __init__(self):
+    def __init__(self, folder="./images/", quotaBytes=None, quotaPercent=80.0, fsyncPolicy=FSYNC_BATCH):
         logging.getLogger("HABControl")
         logging.info('Initialising Camera Module')
+        self.folder = folder
         try:
+            self.storage = StorageManager(folder, quotaBytes=quotaBytes, quotaPercent=quotaPercent, fsyncPolicy=fsyncPolicy)
             self.camera = PiCamera()
             self.camera.resolution = (1920, 1080)
             self.camera.meter_mode = 'matrix'
+            self.camera.annotate_background = Color('black')
+            self.camera.annotate_text_size = 32
             self.camera.start_preview()
+            self.candidates = []
+            self.candidatesLock = Lock()
     
             Thread.__init__(self)
             self.healthy = True
@@ -30,36 +67,198 @@ class CameraModule(Thread):
 
     def run(self):
         while self.healthy:
-            self.saveCameraImage()
-            time.sleep(2)
+            if self.isBursting():
+                self.captureBurst()
+            else:
+                self.saveCameraImage()
+                time.sleep(2)
+
+    def startBurst(self, duration=60.0, interval=0.0):
+        # switch the capture thread to continuous video port capture for a while
+        self.burstInterval = interval
+        self.burstUntil = time.monotonic() + duration
+        logging.info("Camera burst mode for %.0f seconds" % duration)
+
+    def stopBurst(self):
+        self.burstUntil = 0.0
 
-    def saveCameraImage(self, folder="./images/"):
+    def isBursting(self):
+        return time.monotonic() < self.burstUntil
+
+    def updateAnnotation(self):
+        # the annotate properties are only written when the text actually changes
+        text = "RaliSat-1 : " + datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        if text != self.annotation:
+            self.camera.annotate_text = text
+            self.annotation = text
+
+    def captureBurst(self):
+        # one recycled in-memory buffer, no still port mode switch per frame
+        stream = io.BytesIO()
+        frame = 0
+        nextScore = 0.0
         try:
-            self.camera.annotate_background = Color('black')
-            self.camera.annotate_text = "RaliSat-1 : " + datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            self.camera.annotate_text_size = 32
+            self.updateAnnotation()
+            for _ in self.camera.capture_continuous(stream, format='jpeg', use_video_port=True):
+                filePath = self.folder + "hab-" + time.strftime("%d-%H%M%S") + "-%02d.jpg" % (frame % 100)
+                # only a subset is decoded and scored, the rest goes straight to the storage queue
+                if time.monotonic() >= nextScore:
+                    nextScore = time.monotonic() + BURST_SCORE_INTERVAL
+                    self.processCapture(filePath, stream)
+                else:
+                    self.storage.store(filePath, stream.getvalue(), timeout=BURST_STORE_TIMEOUT)
+                    self.lastSavedFile = filePath
+                stream.seek(0)
+                stream.truncate()
+                frame += 1
+                if not self.healthy or not self.isBursting():
+                    break
+                self.updateAnnotation()
+                if self.burstInterval > 0:
+                    time.sleep(self.burstInterval)
+            logging.info("Camera burst captured %d frames" % frame)
+        except Exception as e:
+            logging.error("Unable to read Camera - %s" % str(e), exc_info=True)
+            self.healthy = False
 
-            filePath = folder + "hab-" + time.strftime("%d-%H%M%S") + ".jpg"
-            self.camera.capture(filePath)
-            self.lastSavedFile = filePath
+    def saveCameraImage(self):
+        try:
+            self.updateAnnotation()
+            filePath = self.folder + "hab-" + time.strftime("%d-%H%M%S") + ".jpg"
+            stream = io.BytesIO()
+            self.camera.capture(stream, format='jpeg')
+            self.processCapture(filePath, stream)
         except Exception as e:
             logging.error("Unable to read Camera - %s" % str(e), exc_info=True)
             self.healthy = False
 
-    def getThumbnailImage(self):
-        if self.lastSavedFile == None or self.camera == None:
-            return None
+    def processCapture(self, filePath, stream):
+        stream.seek(0)
+        (preview, data) = self.createThumbnail(stream)
+        # scored on the small preview, not the full frame
+        (score, imageHash) = scoreImage(preview) if preview is not None else (0.0, None)
+        # written to SD by the storage thread
+        self.storage.store(filePath, stream.getvalue(), score)
+        self.lastSavedFile = filePath
+        if preview is not None:
+            self.addCandidate(filePath, data, preview, score, imageHash)
 
+    def createThumbnail(self, stream):
         try:
-            thbnl = Image.open(self.lastSavedFile)
-            thbnl.thumbnail((640,360))
-            imgByteArr = io.BytesIO()
-            thbnl.save(imgByteArr, format="jpeg", quality=75)
-            return imgByteArr.getvalue()
+            thbnl = Image.open(stream)
+            # let the JPEG decoder downscale in the DCT domain instead of decoding full resolution
+            thbnl.draft('RGB', THUMBNAIL_SIZE)
+            thbnl.thumbnail(THUMBNAIL_SIZE)
+            return (thbnl, self.encodeImage(thbnl, THUMBNAIL_QUALITY))
         except Exception as e:
             logging.error("Error creating thumbnail image - %s" % str(e), exc_info=True)
+            return (None, None)
+
+    def encodeImage(self, image, quality, subsampling=SUBSAMPLING_420):
+        imgByteArr = io.BytesIO()
+        image.save(imgByteArr, format="jpeg", quality=quality, subsampling=subsampling, optimize=True)
+        return imgByteArr.getvalue()
+
+    def addCandidate(self, filePath, data, preview, score, imageHash):
+        if self.lastSentHash is not None and hammingDistance(imageHash, self.lastSentHash) <= DUPLICATE_DISTANCE:
+            logging.debug("Skipping %s, duplicate of last sent frame" % filePath)
+            return
+        with self.candidatesLock:
+            self.candidates.append((score, filePath, data, preview, imageHash))
+            self.candidates.sort(key=lambda c: c[0], reverse=True)
+            del self.candidates[CANDIDATE_COUNT:]
+
+    def selectFrame(self):
+        # best scoring frame captured since the last one sent, state only changes in frameSent()
+        with self.candidatesLock:
+            candidates = [c for c in self.candidates
+                if self.lastSentHash is None or hammingDistance(c[4], self.lastSentHash) > DUPLICATE_DISTANCE]
+        if not candidates:
+            return None
+        frame = candidates[0]
+        logging.debug("Selected %s with score %.2f" % (frame[1], frame[0]))
+        return frame
+
+    def frameSent(self):
+        # the image last returned for downlink was queued, which starts a new candidate window
+        frame = self.pendingFrame
+        if frame is None:
+            return
+        self.pendingFrame = None
+        self.lastSentHash = frame[4]
+        with self.candidatesLock:
+            self.candidates = []
+
+    def getThumbnailImage(self, byteBudget=None):
+        if self.camera == None:
+            return None
+
+        # thumbnails are built and scored by the camera thread at capture time
+        frame = self.selectFrame()
+        if frame is None:
+            return None
+        (score, filePath, data, preview, imageHash) = frame
+        if byteBudget is not None:
+            data = self.fitImage(filePath, preview, byteBudget)
+        if data is not None:
+            self.pendingFrame = frame
+        return data
+
+    def getThumbnailTiles(self, imageId, size=TILED_IMAGE_SIZE):
+        # independently decodable tiles of the best unsent frame
+        if self.camera == None:
+            return None
+        frame = self.selectFrame()
+        if frame is None:
+            return None
+        (score, filePath, data, preview, imageHash) = frame
+        try:
+            image = preview if preview.size == size else preview.resize(size, Image.LANCZOS)
+            tiles = encodeTiles(image, imageId)
+            self.pendingFrame = frame
+            return tiles
+        except Exception as e:
+            logging.error("Error creating image tiles - %s" % str(e), exc_info=True)
+            return None
+
+    def fitImage(self, filePath, preview, byteBudget):
+        # encodes are cached per (size, quality, subsampling) for the current file
+        (cacheFile, cache) = self.encodeCache
+        if cacheFile != filePath:
+            cache = {}
+            self.encodeCache = (filePath, cache)
+
+        def encode(size, quality, subsampling=SUBSAMPLING_420):
+            key = (size, quality, subsampling)
+            if key not in cache:
+                image = preview if preview.size == size else preview.resize(size, Image.LANCZOS)
+                cache[key] = self.encodeImage(image, quality, subsampling)
+            return cache[key]
+
+        # largest resolution first, then the highest quality that fits the budget
+        for size in RATE_CONTROL_SIZES:
+            if size[0] > preview.size[0]:
+                continue
+            if len(encode(size, RATE_CONTROL_MIN_QUALITY)) > byteBudget:
+                continue
+            low = RATE_CONTROL_MIN_QUALITY
+            high = RATE_CONTROL_MAX_QUALITY
+            while low < high:
+                mid = (low + high + 1) // 2
+                if len(encode(size, mid)) <= byteBudget:
+                    low = mid
+                else:
+                    high = mid - 1
+            # spend spare budget on full chroma resolution
+            if low == RATE_CONTROL_MAX_QUALITY and len(encode(size, low, SUBSAMPLING_444)) <= byteBudget:
+                return encode(size, low, SUBSAMPLING_444)
+            logging.debug("Rate control: %dx%d quality %d for budget %d" % (size[0], size[1], low, byteBudget))
+            return encode(size, low)
+        logging.info("No thumbnail fits the byte budget %d" % byteBudget)
+        return None
 
     def close(self):
         self.healthy = False
         self.camera.stop_preview()
         self.camera.close()
+        self.storage.close()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import random
+from struct import *
+
+# Rateless erasure code for image transfers. The first k symbols are the
+# source blocks themselves, every later symbol is the XOR of a pseudo random
+# subset of them chosen from the transfer id and symbol index, so both ends
+# derive it without sending coefficients. Any k linearly independent symbols
+# rebuild the data, which in practice takes k plus one or two received
+# symbols whichever ones were lost.
+
+SYMBOL_HEADER = Struct('>BHH') # transfer id, total size, symbol index
+REPAIR_OVERHEAD = 0.25 # repair symbols sent up front, as a share of the source blocks
+TOPUP_FRACTION = 0.05 # more repair symbols queued when those are sent without completion
+MAX_SYMBOL_FACTOR = 4 # a transfer is abandoned after this many times k symbols
+
+def _coefficients(transferId, index, k):
+    # bit i set means source block i is part of the symbol
+    if index < k:
+        return 1 << index
+    coefficients = 0
+    rng = random.Random((transferId << 16) | index)
+    while coefficients == 0:
+        coefficients = rng.getrandbits(k)
+    return coefficients
+
+class FountainEncoder:
+    def __init__(self, data, transferId, symbolSize):
+        if len(data) > 0xffff:
+            raise ValueError("data too large for a fountain transfer: %d bytes" % len(data))
+        self.transferId = transferId & 0xff
+        self.size = len(data)
+        self.symbolSize = symbolSize
+        self.k = (len(data) + symbolSize - 1) // symbolSize
+        padded = bytes(data) + bytes(self.k * symbolSize - len(data))
+        self.blocks = [int.from_bytes(padded[i*symbolSize:(i+1)*symbolSize], 'big') for i in range(self.k)]
+        self.nextIndex = 0
+
+    def symbol(self, index):
+        coefficients = _coefficients(self.transferId, index, self.k)
+        value = 0
+        while coefficients:
+            low = coefficients & -coefficients
+            value ^= self.blocks[low.bit_length() - 1]
+            coefficients ^= low
+        return SYMBOL_HEADER.pack(self.transferId, self.size, index) + value.to_bytes(self.symbolSize, 'big')
+
+    def symbols(self, count):
+        '''the next count symbols, source blocks first'''
+        first = self.nextIndex
+        self.nextIndex = min(0xffff + 1, first + count)
+        return [self.symbol(index) for index in range(first, self.nextIndex)]
+
+class FountainDecoder:
+    '''ground side decoder, symbols are eliminated as they arrive'''
+    def __init__(self):
+        self.transferId = None
+        self.size = 0
+        self.k = 0
+        self.symbolSize = 0
+        self.pivots = {} # lowest set bit -> (coefficients, value)
+        self.received = 0
+        self.data = None
+
+    def addSymbol(self, record):
+        # returns True once the transfer is decoded
+        (transferId, size, index) = SYMBOL_HEADER.unpack_from(record)
+        symbolSize = len(record) - SYMBOL_HEADER.size
+        if transferId != self.transferId or size != self.size or symbolSize != self.symbolSize:
+            self.__init__()
+            self.transferId = transferId
+            self.size = size
+            self.symbolSize = symbolSize
+            self.k = (size + symbolSize - 1) // symbolSize
+        if self.data is not None:
+            return True
+
+        self.received += 1
+        coefficients = _coefficients(transferId, index, self.k)
+        value = int.from_bytes(record[SYMBOL_HEADER.size:], 'big')
+        while coefficients:
+            bit = (coefficients & -coefficients).bit_length() - 1
+            if bit not in self.pivots:
+                self.pivots[bit] = (coefficients, value)
+                break
+            (c, v) = self.pivots[bit]
+            coefficients ^= c
+            value ^= v
+        if len(self.pivots) == self.k:
+            self.solve()
+        return self.data is not None
+
+    def solve(self):
+        # back substitution, each pivot row only has bits above its own
+        blocks = [0] * self.k
+        for bit in range(self.k - 1, -1, -1):
+            (coefficients, value) = self.pivots[bit]
+            coefficients ^= 1 << bit
+            while coefficients:
+                low = coefficients & -coefficients
+                value ^= blocks[low.bit_length() - 1]
+                coefficients ^= low
+            blocks[bit] = value
+        self.data = b''.join(b.to_bytes(self.symbolSize, 'big') for b in blocks)[:self.size]
+        self.pivots = {}
+
+    def complete(self):
+        return self.data is not None
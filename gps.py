@@ -1,9 +1,19 @@
 #!/usr/bin/env python3
 
-import logging, math
-from ublox import *
+import logging, time
+from datetime import datetime
+from ublox import UBlox, CLASS_NAV, MSG_NAV_POSLLH, MSG_NAV_SOL, MSG_NAV_PVT, DYNAMIC_MODEL_AIRBORNE1G, DYNAMIC_MODEL_PEDESTRIAN
+from altitude import pressureAltitude
+from snapshot import Snapshot
 from threading import Thread
 
+# navigation message modes
+NAV_MODE_POSLLH_SOL = 0 # separate NAV_POSLLH and NAV_SOL messages
+NAV_MODE_PVT = 1        # single NAV_PVT message per epoch (u-blox 7 and later)
+
+class GPSSnapshot(Snapshot):
+    __slots__ = ('sequence', 'timestamp', 'itow', 'latitude', 'longitude', 'altitude', 'fix_status', 'satellites')
+
 class GPSModule(Thread):
     gps = None
     latitude = 0.0
@@ -11,20 +21,47 @@ class GPSModule(Thread):
     altitude = 0.0
     fix_status = 0
     satellites = 0
+    velocity_north = 0.0
+    velocity_east = 0.0
+    velocity_down = 0.0
+    horizontal_accuracy = 0.0
+    vertical_accuracy = 0.0
+    utc_time = None
+    position_itow = None
+    position_received = None
+    status_itow = None
+    status_received = None
+    backlog = 0
+    sequence = 0
+    snapshot = GPSSnapshot(0, None, None, 0.0, 0.0, 0.0, 0, 0)
     healthy = True
     onHighAltitude = False
 
-    def __init__(self, portname="/dev/ttyUSB0", timeout=2, baudrate=9600):
+    def __init__(self, portname="/dev/ttyUSB0", timeout=2, baudrate=9600, navMode=NAV_MODE_POSLLH_SOL, altitudeFilter=None):
         logging.getLogger("HABControl")
         logging.info('Initialising GPS Module')
+        self.altitudeFilter = altitudeFilter
         try:
             self.gps = UBlox(port=portname, timeout=timeout, baudrate=baudrate)
             self.gps.set_binary()
             self.gps.configure_poll_port()
             self.gps.configure_solution_rate(rate_ms=1000)
             self.gps.set_preferred_dynamic_model(DYNAMIC_MODEL_PEDESTRIAN)
-            self.gps.configure_message_rate(CLASS_NAV, MSG_NAV_POSLLH, 1)
-            self.gps.configure_message_rate(CLASS_NAV, MSG_NAV_SOL, 1)
+            if navMode == NAV_MODE_PVT:
+                self.gps.configure_message_rate(CLASS_NAV, MSG_NAV_POSLLH, 0)
+                self.gps.configure_message_rate(CLASS_NAV, MSG_NAV_SOL, 0)
+                self.gps.configure_message_rate(CLASS_NAV, MSG_NAV_PVT, 1)
+                self.gps.subscribe(CLASS_NAV, MSG_NAV_PVT, self.onMessage)
+                self.handlers = {(CLASS_NAV, MSG_NAV_PVT): self.onNavPvt}
+            else:
+                self.gps.configure_message_rate(CLASS_NAV, MSG_NAV_POSLLH, 1)
+                self.gps.configure_message_rate(CLASS_NAV, MSG_NAV_SOL, 1)
+                self.gps.subscribe(CLASS_NAV, MSG_NAV_SOL, self.onMessage)
+                self.gps.subscribe(CLASS_NAV, MSG_NAV_POSLLH, self.onMessage)
+                self.handlers = {(CLASS_NAV, MSG_NAV_SOL): self.onNavSol,
+                                 (CLASS_NAV, MSG_NAV_POSLLH): self.onNavPosLLH}
+
+            self.pending = {}
 
             Thread.__init__(self)
             self.healthy = True
@@ -35,18 +72,22 @@ class GPSModule(Thread):
             self.healthy = False
 
     def run(self):
+        # process_messages() blocks on the serial port until data arrives
         while self.healthy:
             self.readData()
-            time.sleep(1.0)
+
+    def fixAge(self):
+        if self.position_received is None:
+            return None
+        return time.monotonic() - self.position_received
 
     def checkPressure(self, pressure):
-        alt = 0.0
-        if pressure is not 0:
-            alt = 44330.0 * (1.0 - math.pow(pressure / 1013.25, 0.1903))
-        self.checkAltitude(alt)
+        alt = pressureAltitude(pressure)
+        if alt is not None:
+            self.checkAltitude(alt)
 
     def checkAltitude(self, altitude):
-        if altitude is not 0:
+        if altitude != 0:
             if altitude > 9000 and not self.onHighAltitude:
                 self.onHighAltitude = True
                 self.gps.set_preferred_dynamic_model(DYNAMIC_MODEL_AIRBORNE1G)
@@ -54,24 +95,67 @@ class GPSModule(Thread):
                 self.onHighAltitude = False
                 self.gps.set_preferred_dynamic_model(DYNAMIC_MODEL_PEDESTRIAN)
 
+    def onMessage(self, msg):
+        # keep only the newest frame of each type until the backlog is drained
+        self.pending[msg.msg_type()] = msg
+
+    def onNavSol(self, msg):
+        self.status_itow = msg.iTOW
+        self.status_received = msg._received
+        self.satellites = msg.numSV
+        self.fix_status = msg.gpsFix
+
+    def onNavPosLLH(self, msg):
+        self.position_itow = msg.iTOW
+        self.position_received = msg._received
+        self.latitude = msg.Latitude * 1e-7
+        self.longitude = msg.Longitude * 1e-7
+        self.altitude = msg.hMSL / 1000.0
+        if self.altitudeFilter is not None and self.fix_status >= 3:
+            self.altitudeFilter.addGnss(self.altitude, None, msg._received)
+
+        if self.altitude < 0.0:
+            self.altitude = 0.0
+
+    def onNavPvt(self, msg):
+        self.position_itow = self.status_itow = msg.iTOW
+        self.position_received = self.status_received = msg._received
+        self.satellites = msg.numSV
+        self.fix_status = msg.fixType
+        self.latitude = msg.lat * 1e-7
+        self.longitude = msg.lon * 1e-7
+        self.altitude = max(msg.hMSL / 1000.0, 0.0)
+        self.velocity_north = msg.velN / 1000.0
+        self.velocity_east = msg.velE / 1000.0
+        self.velocity_down = msg.velD / 1000.0
+        self.horizontal_accuracy = msg.hAcc / 1000.0
+        self.vertical_accuracy = msg.vAcc / 1000.0
+        if self.altitudeFilter is not None and self.fix_status >= 3:
+            self.altitudeFilter.addGnss(msg.hMSL / 1000.0, self.velocity_down, msg._received)
+
+        # validDate and validTime flags
+        if msg.validFlags & 0x3 == 0x3:
+            self.utc_time = datetime(msg.year, msg.month, msg.day, msg.hour, msg.min, min(msg.sec, 59))
+
+    def publish(self):
+        self.sequence += 1
+        self.snapshot = GPSSnapshot(self.sequence, self.position_received, self.position_itow,
+            self.latitude, self.longitude, self.altitude, self.fix_status, self.satellites)
+
     def readData(self):
         try:
-            msg = self.gps.receive_message()
-    
-            if msg is not None:
-                logging.debug(msg)
-                if msg.name() == "NAV_SOL":
-                    msg.unpack()
-                    self.satellites = msg.numSV
-                    self.fix_status = msg.gpsFix
-                elif msg.name() == "NAV_POSLLH":
-                    msg.unpack()
-                    self.latitude = msg.Latitude * 1e-7
-                    self.longitude = msg.Longitude * 1e-7
-                    self.altitude = msg.hMSL / 1000.0
-
-                    if self.altitude < 0.0:
-                        self.altitude = 0.0
+            self.gps.process_messages()
+            while self.gps.pending_bytes() > 0:
+                self.gps.process_messages()
+            self.backlog = self.gps.backlog()
+
+            # only the newest solution of each type is decoded and published
+            pending = self.pending
+            self.pending = {}
+            for (msg_type, msg) in pending.items():
+                self.handlers[msg_type](msg)
+            if pending:
+                self.publish()
         except Exception as e:
             logging.error("Unable to read from GPS Chip - %s" % str(e), exc_info=True)
             self.healthy = False
@@ -5,17 +5,22 @@ from struct import *
 from gpiozero import DiskUsage, LoadAverage, CPUTemperature
 from datetime import datetime
 
+from altitude import *
 from gps import *
 from bme import *
 from lora import *
 from camera import *
+from telemetry import TelemetryEncoder
 
 logging.basicConfig(format='[%(levelname)s]:[%(asctime)s]:%(message)s', filename='habcontrol.log', level=logging.ERROR)
 logging.getLogger("HABControl")
 logging.info('Starting High Altitude Balloon Controller...')
 
-gps = GPSModule()
-bme680 = BME680Module()
+TELEMETRY_INTERVAL = 5.0 # seconds between telemetry packets, also the sensor summary window
+
+altitudeFilter = AltitudeFilter()
+gps = GPSModule(altitudeFilter=altitudeFilter)
+bme680 = BME680Module(summaryWindow=TELEMETRY_INTERVAL, altitudeFilter=altitudeFilter)
 lora = LoraModule(addressLow=0x01, dataTimer=True, delay=0.25)
 camera = CameraModule()
 logging.info("Loaded all thread modules")
@@ -23,32 +28,85 @@ rpi_disk = DiskUsage()
 rpi_load = LoadAverage()
 rpi_cpu = CPUTemperature()
 
-fmt = '>fffBfffHBL'
-logging.debug("Size of packet: %d" % calcsize(fmt))
+# image downlink: whole JPEG in chunks, independently decodable tiles, or erasure coded symbols
+IMAGE_MODE_CHUNKED = 0
+IMAGE_MODE_TILED = 1
+IMAGE_MODE_FEC = 2
+imageMode = IMAGE_MODE_CHUNKED
+imageId = 0
+lastPhase = PHASE_GROUND
+
+telemetryEncoder = TelemetryEncoder()
+lastPackedSequences = None
 
 def packData():
+    global lastPackedSequences
+    gpsData = gps.snapshot
+    envData = bme680.snapshot
+    sequences = (gpsData.sequence, envData.sequence)
+    if sequences == lastPackedSequences:
+        # nothing new from either sensor since the last packet
+        return None
+    lastPackedSequences = sequences
+
+    (fusedAltitude, verticalRate) = altitudeFilter.state()
     tmstamp = int(datetime.utcnow().timestamp())
-    fixpack = ((gps.fix_status & 0xf) << 4) | (gps.satellites & 0xf)
+    fixpack = ((gpsData.fix_status & 0xf) << 4) | (gpsData.satellites & 0xf)
     output_data = (
-        gps.latitude, gps.longitude, gps.altitude, fixpack, 
-        bme680.temperature, bme680.pressure, bme680.humidity, round(bme680.airQuality),
-        round(rpi_cpu.temperature), tmstamp)
+        gpsData.latitude, gpsData.longitude, gpsData.altitude, fixpack,
+        envData.temperature, envData.pressure, envData.humidity, round(envData.airQuality),
+        round(rpi_cpu.temperature), fusedAltitude, verticalRate)
 
     logging.debug(output_data)
-    packed_data = pack(fmt, *output_data)
+    logging.debug("GPS fix age: %s backlog: %d bytes" % (gps.fixAge(), gps.backlog))
+    packed_data = telemetryEncoder.encode(output_data, tmstamp)
+    logging.debug("Size of packet: %d" % len(packed_data))
     return packed_data
 
+def flightPhase(altitude, verticalRate):
+    if verticalRate > 2.0:
+        return PHASE_ASCENT
+    if verticalRate < -2.0:
+        return PHASE_DESCENT
+    if altitude > 10000:
+        return PHASE_FLOAT
+    return PHASE_GROUND
+
 logging.info('Polling:')
 try:
     while lora.healthy and gps.healthy and camera.healthy and bme680.healthy:
-        gps.checkAltitude(gps.altitude)
-        gps.checkPressure(bme680.pressure)
-        lora.sendData(packData())
-        lora.join(5)
-        if not lora.hasChunkData():
-            thumbnail = camera.getThumbnailImage()
-            if thumbnail is not None:
-                lora.sendData(thumbnail)
+        if altitudeFilter.initialised:
+            (altitude, verticalRate) = altitudeFilter.state()
+            gps.checkAltitude(altitude)
+            phase = flightPhase(altitude, verticalRate)
+            bme680.setFlightPhase(phase)
+            if phase == PHASE_DESCENT and lastPhase in (PHASE_ASCENT, PHASE_FLOAT):
+                # balloon burst, record it at video port rate
+                camera.startBurst(duration=60.0)
+            lastPhase = phase
+        else:
+            gps.checkAltitude(gps.altitude)
+        logging.debug("Disk usage: %.1f%% storage: %s" % (rpi_disk.usage, camera.storage.metrics()))
+        logging.debug("Lora frames: %d fill ratio: %.2f throughput: %.1f B/s" % (lora.framesSent, lora.fillRatio, lora.throughput))
+        packet = packData()
+        if packet is not None:
+            lora.sendData(packet)
+        lora.join(TELEMETRY_INTERVAL)
+        if imageMode == IMAGE_MODE_TILED:
+            if not lora.hasTileData():
+                tiles = camera.getThumbnailTiles(imageId)
+                if tiles is not None and lora.sendTiles(tiles):
+                    camera.frameSent()
+                    imageId = (imageId + 1) & 0xff
+        elif imageMode == IMAGE_MODE_FEC:
+            if not lora.hasFecData():
+                thumbnail = camera.getThumbnailImage(lora.imageByteBudget())
+                if thumbnail is not None and lora.sendFec(thumbnail):
+                    camera.frameSent()
+        elif not lora.hasChunkData():
+            thumbnail = camera.getThumbnailImage(lora.imageByteBudget())
+            if thumbnail is not None and lora.sendData(thumbnail):
+                camera.frameSent()
 except KeyboardInterrupt:
     logging.info("Closing program")
 except Exception as e:
@@ -4,6 +4,10 @@ import time, io, os, logging, serial, pickle
 from pathlib import Path
 from struct import *
 from lora import *
+from imagetiles import TileCanvas
+from fountain import FountainDecoder
+from telemetry import TelemetryDecoder, FIELDS as TELEMETRY_FIELDS
+from linkrate import AIR_RATES, DEFAULT_AIR_RATE, GROUND_FALLBACK_TIMEOUT, rateName
 import shutil
 import RPi.GPIO as GPIO
 
@@ -20,21 +24,23 @@ GPIO.setmode(GPIO.BCM)
 GPIO.setup(BUZZER_PIN, GPIO.OUT)
 lora = LoraModule(addressLow=0x02, dataTimer=False, delay=0.25)
 
+telemetryDecoder = TelemetryDecoder()
+
 def extractSensorData(data):
-    fmt = '>fffBfffHBL'
-    packetSize = calcsize(fmt)
-    logging.debug('Packet Size: %d' % packetSize)
+    for sample in telemetryDecoder.decode(data):
+        writeSensorData(sample)
 
-    (gps_latitude, gps_longitude, gps_altitude, fixpack, 
+def writeSensorData(sample):
+    (gps_latitude, gps_longitude, gps_altitude, fixpack,
         env_temperature, env_pressure, env_humidity, env_air_quality,
-        rpi_cpu_temperature, tmstamp) = unpack(fmt, data)
+        rpi_cpu_temperature, fused_altitude, vertical_rate) = (sample[name] for name in TELEMETRY_FIELDS)
     gps_fix_status = (fixpack >> 4) & 0xf
     gps_satellites = fixpack & 0xf
 
-    tmstamp = datetime.fromtimestamp(tmstamp)
+    tmstamp = datetime.fromtimestamp(sample['timestamp'])
     logging.debug((gps_latitude, gps_longitude, gps_altitude, gps_fix_status, gps_satellites, 
         env_temperature, env_pressure, env_humidity, env_air_quality,
-        rpi_cpu_temperature, tmstamp))
+        rpi_cpu_temperature, tmstamp, fused_altitude, vertical_rate))
 
     json_body = [{
         "measurement": "payloaddata",
@@ -55,6 +61,10 @@ def extractSensorData(data):
     if gps_fix_status > 2 and gps_altitude is not 0:
         json_body[0]["fields"]["altitude"] = gps_altitude
 
+    if not (fused_altitude == 0 and vertical_rate == 0):
+        json_body[0]["fields"]["fusedaltitude"] = fused_altitude
+        json_body[0]["fields"]["verticalrate"] = vertical_rate
+
     if gps_fix_status >= 2:
         json_body[0]["fields"]["latitude"] = gps_latitude
         json_body[0]["fields"]["longitude"] = gps_longitude
@@ -80,15 +90,25 @@ updateChunkData({})
 
 def wirteFileData(data):
     fileData = readChunkData()
-    index = int.from_bytes(data[0:2], byteorder='big', signed=False)
-    totalChunks = int.from_bytes(data[2:4], byteorder='big', signed=False)
-    fileData[index] = data[4:]
-    logging.debug("File chunk index: %d / %d" % (index, totalChunks))
-    if len(fileData) == totalChunks:
+    (transferId, offset, totalSize) = CHUNK_HEADER.unpack_from(data)
+    if fileData.get('transfer') != transferId or fileData.get('size') != totalSize:
+        fileData = {'transfer': transferId, 'size': totalSize, 'parts': {}}
+    parts = fileData['parts']
+    parts[offset] = data[CHUNK_HEADER.size:]
+    # chunks may be split at any byte offset, the file is complete once the parts cover it
+    covered = 0
+    for start in sorted(parts):
+        if start > covered:
+            break
+        covered = max(covered, start + len(parts[start]))
+    logging.debug("File chunk offset: %d covered: %d / %d" % (offset, covered, totalSize))
+    if covered >= totalSize:
+        content = bytearray(totalSize)
+        for start in sorted(parts):
+            content[start:start+len(parts[start])] = parts[start]
         file = open('images/latest.jpg', 'wb')
         try:
-            for i in range(0, len(fileData)):
-                file.write(fileData[i])
+            file.write(content)
             file.flush()
             shutil.copyfile('images/latest.jpg', 'images/hab-' + time.strftime("%d-%H%M%S") + ".jpg")
         except Exception as e:
@@ -104,39 +124,164 @@ def wirteFileData(data):
         GPIO.output(BUZZER_PIN, GPIO.LOW)
     updateChunkData(fileData)
 
+fecDecoder = FountainDecoder()
+
+def writeFecData(data):
+    decoded = (fecDecoder.transferId, fecDecoder.size) if fecDecoder.complete() else None
+    if fecDecoder.addSymbol(data) and (fecDecoder.transferId, fecDecoder.size) != decoded:
+        file = open('images/latest.jpg', 'wb')
+        try:
+            file.write(fecDecoder.data)
+            file.flush()
+            shutil.copyfile('images/latest.jpg', 'images/hab-' + time.strftime("%d-%H%M%S") + ".jpg")
+        except Exception as e:
+            logging.error("Error creating image data - %s" % str(e))
+        file.close()
+        logging.info("FEC transfer %d decoded from %d symbols, k %d" % (fecDecoder.transferId, fecDecoder.received, fecDecoder.k))
+        GPIO.output(BUZZER_PIN, GPIO.HIGH)
+        time.sleep(0.2)
+        GPIO.output(BUZZER_PIN, GPIO.LOW)
+
+tileCanvas = TileCanvas()
+
+def writeTileData(data):
+    previous = tileCanvas.addTile(data)
+    if previous is not None:
+        # a new image started, keep whatever arrived of the previous one
+        previous.save('images/hab-' + time.strftime("%d-%H%M%S") + ".jpg")
+    tileCanvas.image.save('images/latest.jpg')
+    logging.debug("Image %d tiles: %d / %d" % (tileCanvas.imageId, len(tileCanvas.received), tileCanvas.total))
+    if tileCanvas.complete():
+        GPIO.output(BUZZER_PIN, GPIO.HIGH)
+        time.sleep(0.2)
+        GPIO.output(BUZZER_PIN, GPIO.LOW)
+
+def missingRanges(maxRanges):
+    # (transfer id, total size, limit, missing ranges below limit) of the chunked file in progress
+    fileData = readChunkData()
+    if 'size' not in fileData:
+        return None
+    parts = fileData['parts']
+    missing = []
+    covered = 0
+    for start in sorted(parts) + [fileData['size']]:
+        if start > covered:
+            if len(missing) == maxRanges:
+                return (fileData['transfer'], fileData['size'], covered, missing)
+            missing.append((covered, start - covered))
+        if start < fileData['size']:
+            covered = max(covered, start + len(parts[start]))
+    return (fileData['transfer'], fileData['size'], fileData['size'], missing)
+
+def sendAcks(ids, fecSymbols=False, airRate=None):
+    global lastNack, lastReport, framesReceived, frameErrors
+    # repeated for every symbol that still arrives in case the payload missed it
+    fecDone = fecDecoder.transferId if fecSymbols and fecDecoder.complete() else None
+    linkReport = None
+    if time.monotonic() - lastReport > REPORT_INTERVAL and framesReceived + frameErrors > 0:
+        linkReport = 100 * frameErrors // (framesReceived + frameErrors)
+        logging.info("Link at %s: %d frames, %d errors" % (rateName(lora.airRate), framesReceived, frameErrors))
+        (framesReceived, frameErrors) = (0, 0)
+        lastReport = time.monotonic()
+    nack = None
+    if ACK_MODE == ACK_MODE_FRAME and time.monotonic() - lastNack > NACK_INTERVAL:
+        nack = missingRanges
+        lastNack = time.monotonic()
+    packet = encodeUplink(ids, ACK_MODE == ACK_MODE_RECORD, fecDone, linkReport, airRate, nack)
+    if packet:
+        lora.transmit(bytes([0xbc, 0x01, 0x04]) + packet) #sending ack
+    if airRate is not None:
+        # the payload switches when it hears the confirmation, so follow it now
+        lora.setAirRate(airRate)
+
+# one ack per received frame with periodic NACKs for image chunks, or one ack per record
+ACK_MODE_RECORD = 0
+ACK_MODE_FRAME = 1
+ACK_MODE = ACK_MODE_FRAME
+FRAME_GAP = 0.05 # serial silence that ends a received frame if the rising AUX edge was missed
+NACK_INTERVAL = 10.0
+lastNack = 0.0
+REPORT_INTERVAL = 10.0
+lastReport = 0.0
+framesReceived = 0
+frameErrors = 0
+
 logging.info('Waiting for signal:')
 try:
+    frameIds = []
+    frameFec = False
+    frameRate = None
+    frameRecords = 0
+    frameBad = False
+    lastReceived = time.monotonic()
     while True:
-        callsign = lora.waitForData(1)
-        if callsign is not None and callsign[0] == 0xda:
-            header = lora.waitForData(3)
-            if header is not None:
-                try:
-                    high = int(header[0]) & 0xff
-                    low = int(header[1]) & 0xff
-                    dataid = (high << 8) | low
-                    dataSize = int.from_bytes([header[2]], byteorder='big', signed=True)
-                    isChunked = dataSize < 0
-                    if isChunked:
-                        dataSize = -dataSize
-                    logging.info("DataId: %d Size: %d isChunked: %d" % (dataid, dataSize, isChunked))
-
-                    data = lora.waitForData(dataSize)
-                    if not isChunked:
+        inFrame = frameRecords > 0 or frameBad
+        if inFrame and lora.rxIdle():
+            callsign = None
+        else:
+            callsign = lora.waitForData(1, timeout=FRAME_GAP if inFrame else 10)
+        if callsign is None:
+            if frameBad:
+                frameErrors += 1
+            elif frameRecords > 0:
+                framesReceived += 1
+            if frameIds or frameFec or frameRate is not None:
+                sendAcks(frameIds, frameFec, frameRate)
+            (frameIds, frameFec, frameRate, frameRecords, frameBad) = ([], False, None, 0, False)
+            if lora.airRate != DEFAULT_AIR_RATE and time.monotonic() - lastReceived > GROUND_FALLBACK_TIMEOUT:
+                logging.error("No frames for %.0f s at %s, falling back" % (time.monotonic() - lastReceived, rateName(lora.airRate)))
+                lora.setAirRate(DEFAULT_AIR_RATE)
+                lastReceived = time.monotonic()
+            continue
+        if callsign[0] not in (RECORD_CALLSIGN, TILE_CALLSIGN, FEC_CALLSIGN, CONTROL_CALLSIGN):
+            frameBad = True
+            continue
+        isTile = callsign[0] == TILE_CALLSIGN
+        isFec = callsign[0] == FEC_CALLSIGN
+        isControl = callsign[0] == CONTROL_CALLSIGN
+        header = lora.waitForData(3)
+        if header is None:
+            frameBad = True
+        else:
+            try:
+                high = int(header[0]) & 0xff
+                low = int(header[1]) & 0xff
+                dataid = (high << 8) | low
+                dataSize = int.from_bytes([header[2]], byteorder='big', signed=True)
+                isChunked = dataSize < 0
+                if isChunked:
+                    dataSize = -dataSize
+                logging.info("DataId: %d Size: %d isChunked: %d" % (dataid, dataSize, isChunked))
+
+                data = lora.waitForData(dataSize)
+                if data is None or len(data) != dataSize:
+                    frameBad = True
+                    continue
+                frameRecords += 1
+                lastReceived = time.monotonic()
+                if isControl:
+                    # control records are answered in the uplink, not acked
+                    if data[0] == RATE_REQUEST and data[1] in AIR_RATES:
+                        frameRate = data[1]
+                elif isFec:
+                    # symbols are never retried, so they are not acked
+                    writeFecData(data)
+                    frameFec = True
+                else:
+                    if isTile:
+                        writeTileData(data)
+                    elif not isChunked:
                         extractSensorData(data)
                     else:
                         wirteFileData(data)
+                    frameIds.append(dataid)
 
-                    packet = bytearray()
-                    packet.append(0xbc)
-                    packet.append(0x01)
-                    packet.append(0x04)
-                    packet.append(0xac)
-                    packet.append(high)
-                    packet.append(low)
-                    lora.transmit(packet) #sending ack
-                except Exception as e:
-                    logging.error("Error while parsing data - %s" % str(e), exc_info=True)
+                if ACK_MODE == ACK_MODE_RECORD:
+                    sendAcks(frameIds, frameFec, frameRate)
+                    (frameIds, frameFec, frameRate) = ([], False, None)
+            except Exception as e:
+                frameBad = True
+                logging.error("Error while parsing data - %s" % str(e), exc_info=True)
 
 except KeyboardInterrupt:
     lora.close()
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+import numpy
+from PIL import Image
+
+SCORE_SIZE = (160, 90)
+
+def laplacianVariance(gray):
+    # variance of the 4-neighbour Laplacian, higher is sharper
+    lap = (gray[1:-1, :-2] + gray[1:-1, 2:] + gray[:-2, 1:-1] + gray[2:, 1:-1]) - 4.0 * gray[1:-1, 1:-1]
+    return float(lap.var())
+
+def exposureScore(gray):
+    # 1.0 for a well spread histogram, towards 0 for black, white or clipped frames
+    histogram = numpy.bincount(gray.astype(numpy.uint8).ravel(), minlength=256) / gray.size
+    clipped = histogram[:8].sum() + histogram[248:].sum()
+    mean = float(gray.mean()) / 255.0
+    return max(0.0, 1.0 - 2.0 * abs(mean - 0.5)) * (1.0 - clipped)
+
+def differenceHash(image):
+    # 64 bit perceptual hash from horizontal gradients of a 9x8 thumbnail
+    small = numpy.asarray(image.convert('L').resize((9, 8), Image.BILINEAR), dtype=numpy.int16)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int(sum(1 << i for (i, bit) in enumerate(bits) if bit))
+
+def hammingDistance(a, b):
+    return bin(a ^ b).count('1')
+
+def scoreImage(image):
+    '''return (score, hash) for a decoded preview image'''
+    gray = numpy.asarray(image.convert('L').resize(SCORE_SIZE, Image.BILINEAR), dtype=numpy.float32)
+    score = numpy.log1p(laplacianVariance(gray)) * exposureScore(gray)
+    return (float(score), differenceHash(image))
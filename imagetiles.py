@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import io, logging
+from struct import *
+from PIL import Image
+from loraframe import MAX_PACKET_SIZE, RECORD_HEADER_SIZE
+
+# Tiled image transport. Every tile is a tiny baseline JPEG whose headers are
+# fully determined by its quality and the fixed tile size, so only the
+# entropy coded data is sent and the receiver rebuilds the headers. Each tile
+# therefore decodes on its own and lost tiles only leave a hole in the image.
+
+TILE_WIDTH = 32
+TILE_HEIGHT = 16
+TILE_HEADER = Struct('>BHBBBBB') # image id, tile index, grid width, grid height, quality, padding right, padding bottom
+TILE_QUALITIES = [50, 35, 25, 15, 8]
+MAX_TILE_SIZE = MAX_PACKET_SIZE - RECORD_HEADER_SIZE
+
+_headerCache = {}
+
+def _encode(image, quality):
+    imgByteArr = io.BytesIO()
+    image.save(imgByteArr, format="jpeg", quality=quality, subsampling=2, optimize=False)
+    return imgByteArr.getvalue()
+
+def _splitJpeg(data):
+    # (headers up to and including the SOS segment, entropy coded data without EOI)
+    sos = data.index(b'\xff\xda')
+    length = unpack('>H', data[sos+2:sos+4])[0]
+    return (data[:sos+2+length], data[sos+2+length:-2])
+
+def tileJpegHeader(quality):
+    if quality not in _headerCache:
+        blank = Image.new('RGB', (TILE_WIDTH, TILE_HEIGHT))
+        _headerCache[quality] = _splitJpeg(_encode(blank, quality))[0]
+    return _headerCache[quality]
+
+def encodeTiles(image, imageId, maxSize=MAX_TILE_SIZE):
+    '''split an image into independently decodable tile records'''
+    columns = (image.size[0] + TILE_WIDTH - 1) // TILE_WIDTH
+    rows = (image.size[1] + TILE_HEIGHT - 1) // TILE_HEIGHT
+    if columns > 255 or rows > 255 or columns * rows > 0xffff:
+        raise ValueError("image too large for tiling: %dx%d" % image.size)
+    # the grid covers whole tiles, the receiver crops it back to the image size
+    padRight = columns * TILE_WIDTH - image.size[0]
+    padBottom = rows * TILE_HEIGHT - image.size[1]
+
+    tiles = []
+    for index in range(columns * rows):
+        x = (index % columns) * TILE_WIDTH
+        y = (index // columns) * TILE_HEIGHT
+        tile = image.crop((x, y, x + TILE_WIDTH, y + TILE_HEIGHT))
+        for quality in TILE_QUALITIES:
+            entropy = _splitJpeg(_encode(tile, quality))[1]
+            if TILE_HEADER.size + len(entropy) <= maxSize:
+                break
+        else:
+            # nothing fits, send the average colour of the tile instead
+            quality = TILE_QUALITIES[-1]
+            flat = Image.new('RGB', tile.size, tile.resize((1, 1), Image.BOX).getpixel((0, 0)))
+            entropy = _splitJpeg(_encode(flat, quality))[1]
+        tiles.append(TILE_HEADER.pack(imageId & 0xff, index, columns, rows, quality, padRight, padBottom) + entropy)
+    return tiles
+
+class TileCanvas:
+    '''ground side canvas that tiles are painted into as they arrive'''
+    def __init__(self):
+        self.imageId = None
+        self.image = None
+        self.received = set()
+        self.total = 0
+
+    def addTile(self, data):
+        # returns the previous image when the tile starts a new one
+        (imageId, index, columns, rows, quality, padRight, padBottom) = TILE_HEADER.unpack(data[:TILE_HEADER.size])
+        previous = None
+        if imageId != self.imageId or self.image is None:
+            previous = self.image
+            self.imageId = imageId
+            self.image = Image.new('RGB', (columns * TILE_WIDTH - padRight, rows * TILE_HEIGHT - padBottom))
+            self.received = set()
+            self.total = columns * rows
+
+        jpeg = tileJpegHeader(quality) + bytes(data[TILE_HEADER.size:]) + b'\xff\xd9'
+        try:
+            tile = Image.open(io.BytesIO(jpeg))
+            tile.load()
+            self.image.paste(tile, ((index % columns) * TILE_WIDTH, (index // columns) * TILE_HEIGHT))
+            self.received.add(index)
+        except Exception as e:
+            logging.error("Unable to decode tile %d of image %d - %s" % (index, imageId, str(e)))
+        return previous
+
+    def complete(self):
+        return self.total > 0 and len(self.received) == self.total
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+import logging, time
+
+# E32 SPED byte: parity (bits 7-6), UART baud rate (bits 5-3), air data rate (bits 2-0)
+SPED_8N1_115200 = 0x38
+AIR_RATE_0K3 = 0x0
+AIR_RATE_1K2 = 0x1
+AIR_RATE_2K4 = 0x2
+AIR_RATE_4K8 = 0x3
+AIR_RATE_9K6 = 0x4
+AIR_RATE_19K2 = 0x5
+
+# rates the link moves between, slowest (longest range) first
+AIR_RATES = (AIR_RATE_2K4, AIR_RATE_4K8, AIR_RATE_9K6, AIR_RATE_19K2)
+# both ends start on this rate, the one the radio always used, and return to
+# it whenever they stop hearing each other; slower rates are only negotiated
+DEFAULT_AIR_RATE = AIR_RATE_19K2
+
+EVAL_INTERVAL = 30.0 # seconds of traffic per loss estimate
+MIN_SAMPLES = 10 # records sent in an interval before it counts
+UP_LOSS = 0.1 # step up when loss stays below this
+DOWN_LOSS = 0.4 # step down when loss goes above this
+MIN_DWELL = 60.0 # seconds on a rate before stepping up
+MAX_DWELL = 900.0
+REQUEST_TIMEOUT = 20.0 # a rate request without a reply may be repeated after this
+FALLBACK_TIMEOUT = 30.0 # payload returns to the default rate after this long without any uplink
+GROUND_FALLBACK_TIMEOUT = 40.0 # ground station returns to the default rate after this long without a frame
+
+def spedByte(airRate):
+    return SPED_8N1_115200 | airRate
+
+def rateName(airRate):
+    return {AIR_RATE_0K3: "0.3k", AIR_RATE_1K2: "1.2k", AIR_RATE_2K4: "2.4k", AIR_RATE_4K8: "4.8k", AIR_RATE_9K6: "9.6k", AIR_RATE_19K2: "19.2k"}.get(airRate, "?")
+
+class LinkAdapter:
+    '''payload side air rate controller
+
+    Loss over each interval is the larger of the share of records sent that
+    were not acked and the frame error ratio the ground station reports. A
+    change of rate is only proposed here; the radio switches once the ground
+    station has confirmed it. Stepping up needs a longer stay on the current
+    rate after every step down, so the link does not oscillate, and any
+    silence longer than FALLBACK_TIMEOUT returns to DEFAULT_AIR_RATE, which
+    the ground station also does on its own.
+    '''
+    def __init__(self, now=None):
+        now = time.monotonic() if now is None else now
+        self.rate = DEFAULT_AIR_RATE
+        self.dwell = MIN_DWELL
+        self.lossRatio = 0.0
+        self.groundErrors = 0.0
+        self.requested = None # (rate, time)
+        self.switched(DEFAULT_AIR_RATE, now)
+
+    def switched(self, rate, now=None):
+        now = time.monotonic() if now is None else now
+        if AIR_RATES.index(rate) > AIR_RATES.index(self.rate):
+            self.dwell = max(MIN_DWELL, self.dwell / 2)
+        self.rate = rate
+        self.rateSince = now
+        self.lastUplink = now
+        self.requested = None
+        self.resetPeriod(now)
+
+    def resetPeriod(self, now):
+        self.periodStart = now
+        self.sent = 0
+        self.acked = 0
+
+    def recordSent(self, count):
+        self.sent += count
+
+    def recordAcked(self, count):
+        self.acked += count
+
+    def uplink(self, now=None):
+        self.lastUplink = time.monotonic() if now is None else now
+
+    def groundReport(self, errorRatio):
+        self.groundErrors = errorRatio
+
+    def shouldFallBack(self, now=None):
+        now = time.monotonic() if now is None else now
+        if self.rate != DEFAULT_AIR_RATE and now - self.lastUplink > FALLBACK_TIMEOUT:
+            self.dwell = min(MAX_DWELL, self.dwell * 2)
+            return True
+        return False
+
+    def evaluate(self, now=None):
+        '''return a rate to request from the ground station, or None'''
+        now = time.monotonic() if now is None else now
+        if self.requested is not None and now - self.requested[1] < REQUEST_TIMEOUT:
+            return None
+        if now - self.periodStart < EVAL_INTERVAL:
+            return None
+        (sent, acked) = (self.sent, self.acked)
+        self.resetPeriod(now)
+        if sent < MIN_SAMPLES:
+            return None
+
+        self.lossRatio = max(0.0, 1.0 - float(acked) / sent, self.groundErrors)
+        index = AIR_RATES.index(self.rate)
+        target = None
+        if self.lossRatio > DOWN_LOSS and index > 0:
+            target = AIR_RATES[index - 1]
+            self.dwell = min(MAX_DWELL, self.dwell * 2)
+        elif self.lossRatio < UP_LOSS and index < len(AIR_RATES) - 1 and now - self.rateSince >= self.dwell:
+            target = AIR_RATES[index + 1]
+        if target is not None:
+            logging.info("Link loss %.2f at %s, requesting %s" % (self.lossRatio, rateName(self.rate), rateName(target)))
+            self.requested = (target, now)
+        return target
@@ -1,12 +1,15 @@
 #!/usr/bin/env python3
 
 import serial
-import logging, time
-from datetime import datetime
-import sqlite3
+import logging, time, math, os, selectors, random
 from struct import *
-from threading import Thread
+from threading import Thread, Event
 import RPi.GPIO as GPIO
+from txqueue import TransmitQueue, RECORD_DATA, RECORD_CHUNK, RECORD_TILE, RECORD_FEC
+from fountain import FountainEncoder, SYMBOL_HEADER, REPAIR_OVERHEAD, TOPUP_FRACTION, MAX_SYMBOL_FACTOR
+from linkrate import LinkAdapter, DEFAULT_AIR_RATE, spedByte, rateName
+from uplink import *
+from loraframe import MAX_PACKET_SIZE, RECORD_HEADER_SIZE
 
 AUX_PIN = 18
 M0_PIN = 17
@@ -17,17 +20,44 @@ MODE_WAKEUP = 1
 MODE_POWER_SAVING = 2
 MODE_SLEEP = 3
 
-MAX_PACKET_SIZE = 58
+AUX_TIMEOUT = 25 # seconds AUX may stay low before the module is considered stuck
+IDLE_WAKEUP = 1.0 # longest sleep of the transmit loop while nothing is due, for acks, maintenance and rate checks
+
+
+RECORD_CALLSIGN = 0xda
+TILE_CALLSIGN = 0xdb
+FEC_CALLSIGN = 0xdc
+CONTROL_CALLSIGN = 0xdd # link control record, sent outside the queue
+RATE_REQUEST = 0x01 # control: switch to air rate
+CHUNK_HEADER = Struct('>BHH') # transfer id, byte offset of the chunk, total size of the data
+CHUNK_SIZE = MAX_PACKET_SIZE - RECORD_HEADER_SIZE - CHUNK_HEADER.size
+MIN_CHUNK_PIECE = 8 # smallest chunk data worth splitting off to fill a frame
+SYMBOL_SIZE = MAX_PACKET_SIZE - RECORD_HEADER_SIZE - SYMBOL_HEADER.size
+
+CALLSIGNS = {RECORD_TILE: TILE_CALLSIGN, RECORD_FEC: FEC_CALLSIGN}
 
 class LoraModule(Thread):
     ser = None
-    dbConn = None
+    queue = None
     delayAfterTransmit = 1.5
     lastTransmitTime = None
     addressHigh = 0x0
     addressLow = 0x0
     port = ""
     healthy = True
+    throughput = 100.0 # bytes per second, measured while the queue keeps the link busy
+    fillRatio = 0.0 # share of MAX_PACKET_SIZE used by the frames sent
+    framesSent = 0
+    minChunkPiece = MIN_CHUNK_PIECE
+    fecOverhead = REPAIR_OVERHEAD
+    fecEncoder = None
+    fecTransferId = 0
+    chunkTransferId = 0
+    rxBuffer = None
+    auxIdle = None
+    selector = None
+    airRate = DEFAULT_AIR_RATE
+    link = None
 
     def __init__(self, port="/dev/serial0", addressHigh=0xbc, addressLow=0x01, dataTimer=True, delay=1.5):
         logging.getLogger("HABControl")
@@ -37,16 +67,34 @@ class LoraModule(Thread):
         GPIO.setup(M0_PIN, GPIO.OUT)
         GPIO.setup(M1_PIN, GPIO.OUT)
         self.delayAfterTransmit = delay
-        self.lastTransmitTime = datetime.now()
+        self.lastTransmitTime = time.monotonic()
         self.addressHigh = addressHigh
         self.addressLow = addressLow
         self.port = port
+        self.rxBuffer = bytearray()
+        self.airRate = DEFAULT_AIR_RATE
+        self.auxIdle = Event()
+        self.auxChanged(AUX_PIN)
+        GPIO.add_event_detect(AUX_PIN, GPIO.BOTH, callback=self.auxChanged)
 
         self.setupPort()
 
         if dataTimer:
-            self.dbConn = sqlite3.connect('data.db', detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
-            self.dbConn.execute("CREATE TABLE IF NOT EXISTS habdata(id INTEGER PRIMARY KEY, data BLOB NOT NULL, chunked INT DEFAULT 0 NOT NULL, created timestamp NOT NULL, ack INT DEFAULT 0 NOT NULL, lasttry timestamp NOT NULL);")
+            # the transmit loop sleeps in select() on the serial port and a pipe that wakeup() writes to
+            (self.wakeReader, self.wakeWriter) = os.pipe()
+            os.set_blocking(self.wakeReader, False)
+            os.set_blocking(self.wakeWriter, False)
+            self.woken = False
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self.ser, selectors.EVENT_READ)
+            self.selector.register(self.wakeReader, selectors.EVENT_READ)
+
+            self.link = LinkAdapter()
+            self.queue = TransmitQueue('data.db', unreliable=(RECORD_FEC,))
+            # the encoder does not survive a restart, so neither do its symbols
+            self.queue.dropKind(RECORD_FEC)
+            self.chunkTransferId = self.nextChunkTransfer()
+            self.queue.listener = self.wakeup
 
             Thread.__init__(self)
             self.healthy = True
@@ -73,8 +121,9 @@ class LoraModule(Thread):
             self.ser.write(packet)
             time.sleep(0.2)
 
-        packet = bytes([0xc0, self.addressHigh, self.addressLow, 0x3d, 0x04, 0xc4])
+        packet = bytes([0xc0, self.addressHigh, self.addressLow, spedByte(self.airRate), 0x04, 0xc4])
         logging.info("Sending Config Packet Size: %d Data: %s" % (len(packet), packet.hex()))
+        self.rxBuffer = bytearray()
         self.ser.write(packet)
         time.sleep(0.1)
         res = self.waitForData(6)
@@ -87,6 +136,72 @@ class LoraModule(Thread):
         self.setMode(MODE_NORMAL)
         time.sleep(0.1)
 
+    def setAirRate(self, airRate):
+        # the module only takes configuration at 9600 baud in sleep mode
+        logging.info("Switching air rate from %s to %s" % (rateName(self.airRate), rateName(airRate)))
+        self.waitForAux()
+        self.airRate = airRate
+        self.ser.baudrate = 9600
+        self.resetLoraModule(False)
+        self.ser.baudrate = 115200
+
+    def auxChanged(self, channel):
+        # AUX is low while the module is transmitting or has data to hand over
+        if GPIO.input(AUX_PIN):
+            self.auxIdle.set()
+        else:
+            self.auxIdle.clear()
+
+    def waitForAux(self, timeout=5):
+        # returns True once AUX is high, the level is read again in case an edge was missed
+        if self.auxIdle.wait(timeout):
+            return True
+        self.auxChanged(AUX_PIN)
+        return self.auxIdle.is_set()
+
+    def wakeup(self):
+        # called from other threads when records are queued, ends the transmit loop's sleep
+        self.woken = True
+        try:
+            os.write(self.wakeWriter, b'\0')
+        except BlockingIOError:
+            pass
+
+    def waitForEvent(self, timeout):
+        # sleeps until uplink data arrives, wakeup() is called or timeout passes, returns True when data is waiting
+        if self.ser.in_waiting > 0:
+            return True
+        for (key, events) in self.selector.select(max(0.0, timeout)):
+            if key.fileobj == self.wakeReader:
+                try:
+                    os.read(self.wakeReader, 64)
+                except BlockingIOError:
+                    pass
+        return self.ser.in_waiting > 0
+
+    def adaptRate(self):
+        # returns True when a control frame was sent this tick
+        now = time.monotonic()
+        if self.link.shouldFallBack(now):
+            logging.error("No uplink for %.0f s at %s, falling back" % (now - self.link.lastUplink, rateName(self.airRate)))
+            self.setAirRate(DEFAULT_AIR_RATE)
+            self.link.switched(DEFAULT_AIR_RATE, now)
+            return False
+        target = self.link.evaluate(now)
+        if target is None:
+            return False
+        packet = bytes([0xbc, 0x02, 0x04, CONTROL_CALLSIGN, 0, 0, 2, RATE_REQUEST, target])
+        self.transmit(packet)
+        return True
+
+    def idleUntil(self):
+        # when to look at the queue again after a tick that had nothing to send
+        now = time.monotonic()
+        due = self.queue.nextDue(now)
+        if due is not None and now < due < now + IDLE_WAKEUP:
+            return due
+        return now + IDLE_WAKEUP
+
     def setMode(self, mode):
         if mode == MODE_NORMAL:
             logging.info("Setting Lora for Normal Mode")
@@ -106,22 +221,25 @@ class LoraModule(Thread):
             GPIO.output(M1_PIN, GPIO.HIGH)
 
     def run(self):
+        idleUntil = 0.0
         while self.healthy:
-            duration = datetime.now() - self.lastTransmitTime
-            secondsFromLastTransmit = duration.total_seconds()
-            while not GPIO.input(AUX_PIN):
-                time.sleep(0.025)
-                duration = datetime.now() - self.lastTransmitTime
-                secondsFromLastTransmit = duration.total_seconds()
-                if secondsFromLastTransmit > 25:
-                    self.healthy = False
-            time.sleep(0.025)
+            if not self.waitForAux(AUX_TIMEOUT):
+                logging.error("Lora module busy for more than %d seconds" % AUX_TIMEOUT)
+                self.healthy = False
+                break
 
             try:
-                if self.ser.in_waiting > 0:
+                due = max(self.lastTransmitTime + self.delayAfterTransmit, idleUntil)
+                if self.waitForEvent(due - time.monotonic()):
                     self.recieveThread()
-                elif secondsFromLastTransmit > self.delayAfterTransmit:
-                    self.transmitThread()
+                elif self.woken:
+                    self.woken = False
+                    idleUntil = 0.0
+                elif time.monotonic() >= due and self.auxIdle.is_set():
+                    if not self.adaptRate() and not self.transmitThread():
+                        idleUntil = self.idleUntil()
+                self.queue.flush()
+                self.queue.maintain()
             except Exception as e:
                 logging.error("Error in Lora module - %s" % str(e), exc_info=True)
                 self.healthy = False
@@ -131,111 +249,236 @@ class LoraModule(Thread):
             logging.info("Sending Packet Size: %d Data: %s" % (len(data), data.hex()))
             self.ser.write(data)
             self.ser.flush()
-            self.lastTransmitTime = datetime.now()
+            now = time.monotonic()
+            interval = now - self.lastTransmitTime
+            if 0 < interval < 10 * self.delayAfterTransmit + 5:
+                self.throughput += 0.1 * (len(data) / interval - self.throughput)
+            self.lastTransmitTime = now
         except Exception as e:
             logging.error("Could not send data to Lora Port - %s" % str(e), exc_info=True)
             self.healthy = False
 
     def transmitThread(self):
+        # returns True when a frame was sent
         try:
             packet = bytearray()
             packet.append(0xbc)
             packet.append(0x02)
             packet.append(0x04)
-            rows = self.dbConn.execute("SELECT * FROM habdata WHERE ack = 0 and lasttry < Datetime('now', '-10 seconds') ORDER BY chunked ASC, created DESC LIMIT 5").fetchall()
-            for row in rows:
-                if len(packet) + len(row[1]) <= MAX_PACKET_SIZE:
-                    packet.append(0xda)
-                    packet.append((int(row[0]) & 0xff00) >> 8) # higher byte of id
-                    packet.append(int(row[0]) & 0xff) # lower byte of id
-                    size = int(len(row[1])) & 0xff
-                    size *= (-1 if row[2] else 1)
-                    size = size.to_bytes(1, byteorder='big', signed=True)[0]
-                    packet.append(size) # size of data
-                    packet.extend(row[1]) # data
-                    self.dbConn.execute("UPDATE habdata SET lasttry = datetime('now') WHERE id = ?", [row[0]])
-                else:
-                    break
+            self.topUpFec()
+            records = self.queue.take(MAX_PACKET_SIZE, overhead=RECORD_HEADER_SIZE, split=self.splitChunk)
+            self.link.recordSent(sum(1 for record in records if record.kind != RECORD_FEC))
+            for record in records:
+                packet.append(CALLSIGNS.get(record.kind, RECORD_CALLSIGN))
+                packet.append((record.wireId & 0xff00) >> 8) # higher byte of id
+                packet.append(record.wireId & 0xff) # lower byte of id
+                size = len(record.data) & 0xff
+                size *= (-1 if record.kind == RECORD_CHUNK else 1)
+                size = size.to_bytes(1, byteorder='big', signed=True)[0]
+                packet.append(size) # size of data
+                packet.extend(record.data) # data
 
             if len(packet) > 3:
+                self.framesSent += 1
+                self.fillRatio += 0.1 * ((len(packet) - 3) / MAX_PACKET_SIZE - self.fillRatio)
                 self.transmit(packet)
+                return True
         except Exception as e:
             logging.error("Could not send data to Lora - %s" % str(e), exc_info=True)
             self.healthy = False
+        return False
 
     def waitForData(self, length, timeout=10):
-        callTime = datetime.now()
-        while self.ser.in_waiting < length:
-            time.sleep(0.025)
-            duration = datetime.now() - callTime
-            secondsFromCallTime = duration.total_seconds()
-            if secondsFromCallTime > timeout:
+        # blocking reads until length bytes are there, bytes of an incomplete read stay in rxBuffer
+        deadline = time.monotonic() + timeout
+        while len(self.rxBuffer) < length:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
                 return None
+            self.ser.timeout = remaining
+            self.rxBuffer.extend(self.ser.read(length - len(self.rxBuffer)))
 
-        data = self.ser.read(length)
+        data = bytes(self.rxBuffer[:length])
+        del self.rxBuffer[:length]
         return data
 
+    def rxIdle(self):
+        # True once the module has handed over everything it received, AUX rises after the last byte
+        return self.auxIdle.is_set() and not self.rxBuffer and self.ser.in_waiting == 0
+
     def recieveThread(self):
-        if self.ser.in_waiting >= 3:
-            try:
-                data = self.ser.read(3)
-                if len(data) == 3 and data[0] == 0xac:
-                    high = int(data[1])
-                    low = int(data[2])
-                    dataid = (high << 8) | low
-                    logging.info("Recieved ACK for %d" % (dataid))
-                    self.dbConn.execute("UPDATE habdata SET ack = 1 WHERE id = ?", [dataid])
-            except Exception as e:
-                logging.error("Could not update ack to SQLite - %s" % str(e), exc_info=True)
+        try:
+            self.rxBuffer.extend(self.ser.read(self.ser.in_waiting))
+            (messages, used) = parseUplink(self.rxBuffer)
+            del self.rxBuffer[:used]
+            if messages:
+                self.link.uplink()
+            acks = [id for (kind, value) in messages if kind in (ACK_RECORD, ACK_FRAME) for id in value]
+            if acks:
+                acked = self.queue.ackMany(acks)
+                self.link.recordAcked(acked)
+                logging.info("Recieved ACK for %s (%d pending)" % (acks, acked))
+            for (kind, value) in messages:
+                if kind == NACK_RANGES:
+                    self.applyNack(*value)
+                elif kind == FEC_DONE:
+                    self.finishFec(value)
+                elif kind == LINK_REPORT:
+                    self.link.groundReport(value / 100.0)
+                elif kind == RATE_ACK:
+                    self.applyRateAck(value)
+        except Exception as e:
+            logging.error("Could not update ack in queue - %s" % str(e), exc_info=True)
+
+    def applyRateAck(self, airRate):
+        if self.link.requested is None or self.link.requested[0] != airRate:
+            logging.error("Unexpected air rate confirmation %s" % rateName(airRate))
+            return
+        # the ground station switches right after its reply, so follow at once
+        self.setAirRate(airRate)
+        self.link.switched(airRate)
 
-    def sendData(self, data):
-        CHUNK_SIZE = MAX_PACKET_SIZE - 8 # CallSign (1 byte) Dataid (2 bytes), Size (1 byte), Chunk index (2 byte), Total Chunks (2 byte)
+    def nextChunkTransfer(self):
+        # chunks still queued from before a restart keep their id, a new file follows it;
+        # without any the ground station may still hold parts of an unknown transfer
+        pending = self.queue.pending(RECORD_CHUNK)
+        if pending:
+            return (max(pending, key=lambda r: r.id).data[0] + 1) & 0xff
+        return random.randrange(256)
 
+    def applyNack(self, transferId, totalSize, limit, missing):
+        # chunks below limit that miss every listed range have arrived, chunks
+        # overlapping one are resent now unless they could still be in flight
+        now = time.monotonic()
+        received = []
+        resend = []
+        for record in self.queue.pending(RECORD_CHUNK):
+            (transfer, offset, size) = CHUNK_HEADER.unpack_from(record.data)
+            end = offset + len(record.data) - CHUNK_HEADER.size
+            if transfer != transferId or size != totalSize or end > limit:
+                continue
+            if any(start < end and offset < start + length for (start, length) in missing):
+                if record.lastSent is not None and now - record.lastSent > (self.queue.srtt or 0.0):
+                    resend.append(record)
+            else:
+                received.append(record.wireId)
+        self.queue.ackMany(received, now, sampleRtt=False)
+        self.queue.expedite(resend, now)
+        logging.info("Recieved NACK for %d ranges, %d acked, %d resent" % (len(missing), len(received), len(resend)))
+
+    def splitChunk(self, record, size):
+        # cut a chunk in two at a byte offset so its head fills the rest of a frame
+        length = size - CHUNK_HEADER.size
+        if record.kind != RECORD_CHUNK or length < self.minChunkPiece or length >= len(record.data) - CHUNK_HEADER.size:
+            return None
+        (transferId, offset, totalSize) = CHUNK_HEADER.unpack_from(record.data)
+        view = memoryview(record.data)[CHUNK_HEADER.size:]
+        return (CHUNK_HEADER.pack(transferId, offset, totalSize) + view[:length], CHUNK_HEADER.pack(transferId, offset + length, totalSize) + view[length:])
+
+    def sendData(self, data, chunkSize=CHUNK_SIZE):
         try:
-            isChunked = len(data) > CHUNK_SIZE
-            totalChunks = int(len(data) / CHUNK_SIZE) + 1
-            if totalChunks > 255 * 255:
+            isChunked = len(data) > chunkSize
+            totalChunks = (len(data) + chunkSize - 1) // chunkSize
+            if len(data) > 0xffff:
                 logging.error("Unable to send file, check file size")
-                return
+                return False
 
             if isChunked:
                 logging.debug("Data: Chunked %d, totalChunks %d" % (isChunked, totalChunks))
-                for i in range(0, totalChunks):
-                    dt = data[i*CHUNK_SIZE:(i+1)*CHUNK_SIZE]
-                    packet = bytearray()
-                    indexBytes = i.to_bytes(2, byteorder='big', signed=False)
-                    packet.append(indexBytes[0])
-                    packet.append(indexBytes[1])
-                    totalChunksBytes = totalChunks.to_bytes(2, byteorder='big', signed=False)
-                    packet.append(totalChunksBytes[0])
-                    packet.append(totalChunksBytes[1])
-                    packet.extend(dt)
-                    logging.debug("Data added to Queue: %s", packet.hex())
-                    self.dbConn.execute("INSERT INTO habdata(data, chunked, created, lasttry) VALUES (?, 1, datetime('now'), datetime('now'));", [sqlite3.Binary(packet)])
+                view = memoryview(data)
+                records = [(CHUNK_HEADER.pack(self.chunkTransferId, offset, len(data)) + view[offset:offset+chunkSize], RECORD_CHUNK) for offset in range(0, len(data), chunkSize)]
+                self.chunkTransferId = (self.chunkTransferId + 1) & 0xff
             else:
                 logging.debug("Data added to Queue: %s", data.hex())
-                self.dbConn.execute("INSERT INTO habdata(data, created, lasttry) VALUES (?, datetime('now'), datetime('now'));", [sqlite3.Binary(data)])
+                records = [(data, RECORD_DATA)]
+            self.queue.enqueue(records)
+            return True
         except Exception as e:
             logging.error("Could not insert to SQLite - %s" % str(e), exc_info=True)
+            return False
 
-    def hasChunkData(self):
+    def sendTiles(self, tiles):
         try:
-            row = self.dbConn.execute("SELECT COUNT(*) FROM habdata WHERE ack = 0 and chunked = 1").fetchone()
-            if row and row[0] > 0:
-                logging.debug("Chunk pending transmit: %d" % (row[0]))
-                return True
-            else:
-                self.dbConn.execute("DELETE FROM habdata WHERE ack = 1 and chunked = 1")
-                return False
+            # tiles of older images that were sent but never acked are dropped, not retried forever
+            self.queue.dropKind(RECORD_TILE)
+            self.queue.enqueue([(tile, RECORD_TILE) for tile in tiles])
+            return True
+        except Exception as e:
+            logging.error("Could not insert to SQLite - %s" % str(e), exc_info=True)
+            return False
+
+    def sendFec(self, data, overhead=None):
+        '''send data erasure coded, k source symbols plus overhead * k repair symbols
+
+        Symbols are sent once and never acked. More repair symbols are queued
+        while the ground station has not reported the transfer decoded.
+        '''
+        overhead = self.fecOverhead if overhead is None else overhead
+        try:
+            self.queue.dropKind(RECORD_FEC)
+            self.fecEncoder = FountainEncoder(data, self.fecTransferId, SYMBOL_SIZE)
+            self.fecTransferId = (self.fecTransferId + 1) & 0xff
+            count = self.fecEncoder.k + int(math.ceil(self.fecEncoder.k * overhead))
+            logging.debug("Data: FEC transfer %d, k %d, symbols %d" % (self.fecEncoder.transferId, self.fecEncoder.k, count))
+            self.queue.enqueue([(symbol, RECORD_FEC) for symbol in self.fecEncoder.symbols(count)])
+            return True
         except Exception as e:
-            logging.error("Could not read from SQLite - %s" % str(e), exc_info=True)
+            self.fecEncoder = None
+            logging.error("Could not insert to SQLite - %s" % str(e), exc_info=True)
             return False
 
+    def topUpFec(self):
+        encoder = self.fecEncoder
+        if encoder is None or self.queue.count(RECORD_FEC) > 0:
+            return
+        if encoder.nextIndex >= encoder.k * MAX_SYMBOL_FACTOR:
+            logging.error("FEC transfer %d abandoned after %d symbols" % (encoder.transferId, encoder.nextIndex))
+            self.fecEncoder = None
+            return
+        self.queue.enqueue([(symbol, RECORD_FEC) for symbol in encoder.symbols(int(math.ceil(encoder.k * TOPUP_FRACTION)))])
+
+    def finishFec(self, transferId):
+        if self.fecEncoder is not None and self.fecEncoder.transferId == transferId:
+            logging.info("FEC transfer %d decoded after %d symbols" % (transferId, self.fecEncoder.nextIndex - self.queue.count(RECORD_FEC)))
+            self.fecEncoder = None
+            self.queue.dropKind(RECORD_FEC)
+
+    def hasFecData(self):
+        return self.fecEncoder is not None
+
+    def hasTileData(self):
+        # tiles still waiting for their first transmission
+        return self.queue.unsentCount(RECORD_TILE) > 0
+
+    def pendingBytes(self):
+        return self.queue.pendingBytes()
+
+    def imageByteBudget(self, interval=300, minBudget=1500, maxBudget=30000):
+        # bytes the link can carry in the next interval after draining what is already queued
+        budget = int(self.throughput * interval) - self.pendingBytes()
+        return max(minBudget, min(maxBudget, budget))
+
+    def hasChunkData(self):
+        count = self.queue.count(RECORD_CHUNK)
+        if count > 0:
+            logging.debug("Chunk pending transmit: %d" % (count))
+            return True
+        return False
+
     def close(self):
         logging.info("Closing Lora Module object")
         self.healthy = False
+        if self.selector is not None:
+            self.wakeup()
+            self.join(IDLE_WAKEUP + self.delayAfterTransmit)
+            self.selector.close()
+            self.selector = None
+            os.close(self.wakeReader)
+            os.close(self.wakeWriter)
+        GPIO.remove_event_detect(AUX_PIN)
         self.ser.close()
         self.ser = None
-        self.dbConn.close()
-        self.dbConn = None
+        if self.queue is not None:
+            self.queue.close()
+            self.queue = None
         GPIO.cleanup()
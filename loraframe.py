@@ -0,0 +1,7 @@
+#!/usr/bin/env python3
+
+# Layout of a LoRa frame, shared by the radio code and the encoders whose
+# records have to fit into one.
+
+MAX_PACKET_SIZE = 58 # bytes on air per frame, the address prefix is not transmitted
+RECORD_HEADER_SIZE = 4 # callsign, id (2 bytes), size
@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+
+class Snapshot:
+    '''immutable set of values published by a sensor thread
+
+    Sensor threads build a new snapshot and replace their reference to it in
+    a single assignment, so readers always see values from one update.
+    '''
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for (name, value) in zip(self.__slots__, values):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is read-only" % type(self).__name__)
+
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__, ", ".join("%s=%r" % (name, getattr(self, name)) for name in self.__slots__))
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+import os, time, shutil, logging, queue
+from threading import Thread, Lock
+
+# fsync policies
+FSYNC_NEVER = 0
+FSYNC_BATCH = 1
+FSYNC_EACH = 2
+
+class StorageManager(Thread):
+    '''write-behind storage for captured images
+
+    Captures are queued as in-memory buffers and written by this thread in
+    batches, so the capture loop never waits on SD card latency. When the
+    stored files exceed the quota, the frame whose removal costs least is
+    deleted: low scoring frames in densely captured stretches go first, so the
+    best frames and an even spread over the flight are kept.
+    '''
+    healthy = True
+    queueDepth = 0
+    writeLatency = 0.0
+    lastWriteLatency = 0.0
+    storedBytes = 0
+    evictedFiles = 0
+    droppedFiles = 0
+
+    def __init__(self, folder="./images/", quotaBytes=None, quotaPercent=80.0, fsyncPolicy=FSYNC_BATCH, batchSize=4, queueSize=16, keepNewest=5):
+        logging.getLogger("HABControl")
+        logging.info('Initialising Storage Manager')
+        self.folder = folder
+        self.quotaBytes = quotaBytes
+        self.quotaPercent = quotaPercent
+        self.fsyncPolicy = fsyncPolicy
+        self.batchSize = batchSize
+        self.keepNewest = keepNewest
+        self.pending = queue.Queue(maxsize=queueSize)
+        self.lock = Lock()
+        self.files = [] # (time, path, size, score) in capture order
+        os.makedirs(folder, exist_ok=True)
+        self.scanFolder()
+
+        Thread.__init__(self)
+        self.healthy = True
+        self.start()
+
+    def scanFolder(self):
+        # files left from an earlier run are kept, but with no score
+        for name in os.listdir(self.folder):
+            if name.endswith(".jpg"):
+                path = os.path.join(self.folder, name)
+                stat = os.stat(path)
+                self.files.append((stat.st_mtime, path, stat.st_size, 0.0))
+        self.files.sort()
+        self.storedBytes = sum(f[2] for f in self.files)
+
+    def store(self, filePath, data, score=0.0, timeout=0.0):
+        # with a timeout the caller waits that long for a free slot before the frame is dropped
+        try:
+            item = (time.time(), filePath, data, score)
+            if timeout > 0:
+                self.pending.put(item, timeout=timeout)
+            else:
+                self.pending.put_nowait(item)
+        except queue.Full:
+            self.droppedFiles += 1
+            logging.error("Storage queue full, dropping %s" % filePath)
+        self.queueDepth = self.pending.qsize()
+
+    def run(self):
+        while self.healthy or not self.pending.empty():
+            try:
+                batch = [self.pending.get(timeout=1.0)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batchSize:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            self.writeBatch(batch)
+            self.queueDepth = self.pending.qsize()
+            self.enforceQuota()
+
+    def writeBatch(self, batch):
+        start = time.monotonic()
+        written = []
+        for (captured, filePath, data, score) in batch:
+            try:
+                with open(filePath, 'wb') as f:
+                    f.write(data)
+                    if self.fsyncPolicy == FSYNC_EACH:
+                        f.flush()
+                        os.fsync(f.fileno())
+                written.append((captured, filePath, len(data), score))
+            except Exception as e:
+                logging.error("Unable to write %s - %s" % (filePath, str(e)), exc_info=True)
+        if self.fsyncPolicy == FSYNC_BATCH and written:
+            os.sync()
+
+        with self.lock:
+            self.files.extend(written)
+            self.storedBytes += sum(f[2] for f in written)
+        self.lastWriteLatency = (time.monotonic() - start) / max(1, len(batch))
+        self.writeLatency += 0.1 * (self.lastWriteLatency - self.writeLatency)
+
+    def quotaLimit(self):
+        limit = self.quotaBytes
+        if self.quotaPercent is not None:
+            usage = shutil.disk_usage(self.folder)
+            # bytes this manager may use so the filesystem stays under quotaPercent
+            allowed = usage.total * self.quotaPercent / 100.0 - (usage.used - self.storedBytes)
+            limit = allowed if limit is None else min(limit, allowed)
+        return limit
+
+    def enforceQuota(self):
+        limit = self.quotaLimit()
+        if limit is None:
+            return
+        while self.storedBytes > limit and len(self.files) > self.keepNewest + 2:
+            self.evict()
+
+    def evict(self):
+        with self.lock:
+            files = self.files
+            scores = [f[3] for f in files]
+            low = min(scores)
+            span = (max(scores) - low) or 1.0
+            # interior frames only, the first frame and the newest ones are always kept
+            best = None
+            for i in range(1, len(files) - self.keepNewest):
+                gap = files[i+1][0] - files[i-1][0]
+                cost = (1.0 + (files[i][3] - low) / span) * gap
+                if best is None or cost < best[0]:
+                    best = (cost, i)
+            (captured, path, size, score) = files.pop(best[1])
+            self.storedBytes -= size
+        try:
+            os.remove(path)
+            self.evictedFiles += 1
+            logging.info("Evicted %s (score %.2f)" % (path, score))
+        except Exception as e:
+            logging.error("Unable to evict %s - %s" % (path, str(e)))
+
+    def metrics(self):
+        usage = shutil.disk_usage(self.folder)
+        return {
+            "storedBytes": self.storedBytes,
+            "storedFiles": len(self.files),
+            "diskPercent": 100.0 * usage.used / usage.total,
+            "writeLatency": self.writeLatency,
+            "queueDepth": self.queueDepth,
+            "evictedFiles": self.evictedFiles,
+            "droppedFiles": self.droppedFiles,
+        }
+
+    def close(self):
+        # pending captures are still written before the thread exits
+        self.healthy = False
+        self.join()
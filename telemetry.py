@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+import json, logging, os, random
+from struct import *
+
+# Telemetry record codec shared by habcontrol and habmonitor. Every value is
+# sent as a fixed-point integer at the resolution given in SCHEMA. A keyframe
+# carries the absolute values and a full UNIX timestamp, the samples after it
+# carry only their difference to that keyframe and the seconds since it, as
+# zig-zag varints. Deltas refer to the keyframe rather than to the previous
+# sample, so a lost or reordered delta never corrupts the ones after it.
+#
+# Keyframe ids restart after a reboot while unsent deltas from before it are
+# still queued, so every record also carries the encoder's epoch, which
+# changes on each start. Keyframes are looked up by epoch and id together.
+#
+# Record layout: version (high nibble) | record type (low nibble), epoch,
+# keyframe id, then for a keyframe the timestamp (uint32) and the values, for
+# a delta the seconds since the keyframe and the value differences.
+
+CODEC_VERSION = 2
+TYPE_KEYFRAME = 0
+TYPE_DELTA = 1
+
+# field name and scale, in the order values are passed and sent
+SCHEMA = (
+    ('latitude', 1e7), # degrees
+    ('longitude', 1e7), # degrees
+    ('altitude', 10), # metres
+    ('fixpack', 1), # fix status (high nibble) and satellites (low nibble)
+    ('temperature', 100), # degrees C
+    ('pressure', 100), # hPa
+    ('humidity', 100), # %RH
+    ('airQuality', 1),
+    ('cpuTemperature', 1), # degrees C
+    ('fusedAltitude', 10), # metres
+    ('verticalRate', 100), # m/s
+)
+FIELDS = tuple(name for (name, scale) in SCHEMA)
+
+KEYFRAME_HEADER = Struct('>BBBL') # version and type, epoch, keyframe id, timestamp
+DELTA_HEADER = Struct('>BBB') # version and type, epoch, keyframe id
+KEYFRAME_INTERVAL = 10 # samples per keyframe
+MAX_DELTA_SECONDS = 600
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+def unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+def encodeVarint(value, out):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def decodeVarint(data, offset):
+    # returns (value, next offset)
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return (value, offset)
+        shift += 7
+
+def toFixed(values):
+    return [int(round(value * scale)) for (value, (name, scale)) in zip(values, SCHEMA)]
+
+def nextEpoch(path):
+    '''epoch for this start, one more than the one saved in path'''
+    epoch = None
+    try:
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                epoch = (int(json.load(f)["epoch"]) + 1) & 0xff
+    except Exception as e:
+        logging.error("Unable to load telemetry epoch - %s" % str(e))
+    if epoch is None:
+        epoch = random.randrange(256)
+    if path is not None:
+        try:
+            tmpPath = path + ".tmp"
+            with open(tmpPath, "w") as f:
+                json.dump({"epoch": epoch}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmpPath, path)
+        except Exception as e:
+            logging.error("Unable to save telemetry epoch - %s" % str(e))
+    return epoch
+
+class TelemetryEncoder:
+    '''payload side, turns samples into keyframe and delta records'''
+    def __init__(self, keyframeInterval=KEYFRAME_INTERVAL, epochFile="telemetryepoch.json"):
+        self.keyframeInterval = keyframeInterval
+        self.epoch = nextEpoch(epochFile)
+        self.keyframeId = 0
+        self.keyframe = None # (timestamp, fixed-point values)
+        self.sinceKeyframe = 0
+
+    def encode(self, values, timestamp):
+        fixed = toFixed(values)
+        timestamp = int(timestamp)
+        out = bytearray()
+        if self.keyframe is None or self.sinceKeyframe >= self.keyframeInterval or not 0 <= timestamp - self.keyframe[0] <= MAX_DELTA_SECONDS:
+            self.keyframeId = (self.keyframeId + 1) & 0xff
+            self.keyframe = (timestamp, fixed)
+            self.sinceKeyframe = 0
+            out.extend(KEYFRAME_HEADER.pack((CODEC_VERSION << 4) | TYPE_KEYFRAME, self.epoch, self.keyframeId, timestamp & 0xffffffff))
+            for value in fixed:
+                encodeVarint(zigzag(value), out)
+        else:
+            self.sinceKeyframe += 1
+            out.extend(DELTA_HEADER.pack((CODEC_VERSION << 4) | TYPE_DELTA, self.epoch, self.keyframeId))
+            encodeVarint(timestamp - self.keyframe[0], out)
+            for (value, base) in zip(fixed, self.keyframe[1]):
+                encodeVarint(zigzag(value - base), out)
+        return bytes(out)
+
+class TelemetryDecoder:
+    '''ground side, returns decoded samples as dicts with a timestamp field
+
+    Deltas that arrive before their keyframe are held until it does. A delta
+    is only ever applied to a keyframe of its own epoch. Every keyframe of the
+    last keepEpochs epochs seen is kept, at most one per 8 bit id, so a delta
+    retried long after its keyframe still decodes.
+    '''
+    def __init__(self, keepEpochs=2, maxPending=32):
+        self.keepEpochs = keepEpochs
+        self.maxPending = maxPending
+        self.keyframes = {} # (epoch, keyframe id) -> (timestamp, fixed-point values)
+        self.epochs = [] # in the order their first keyframe arrived
+        self.pending = [] # ((epoch, keyframe id), seconds, differences)
+
+    def decode(self, data):
+        version = data[0] >> 4
+        if version != CODEC_VERSION:
+            raise ValueError("unsupported telemetry codec version %d" % version)
+        recordType = data[0] & 0xf
+        if recordType == TYPE_KEYFRAME:
+            (header, epoch, keyframeId, timestamp) = KEYFRAME_HEADER.unpack_from(data)
+            key = (epoch, keyframeId)
+            values = self._values(data, KEYFRAME_HEADER.size)
+            self.keyframes.pop(key, None)
+            self.keyframes[key] = (timestamp, values)
+            if epoch not in self.epochs:
+                self.epochs.append(epoch)
+                while len(self.epochs) > self.keepEpochs:
+                    dropped = self.epochs.pop(0)
+                    self.keyframes = {k: v for (k, v) in self.keyframes.items() if k[0] != dropped}
+            samples = [self._sample(timestamp, values)]
+            waiting = [p for p in self.pending if p[0] == key]
+            self.pending = [p for p in self.pending if p[0] != key]
+            for (_, seconds, differences) in waiting:
+                samples.append(self._delta(key, seconds, differences))
+            return samples
+        if recordType == TYPE_DELTA:
+            (header, epoch, keyframeId) = DELTA_HEADER.unpack_from(data)
+            key = (epoch, keyframeId)
+            (seconds, offset) = decodeVarint(data, DELTA_HEADER.size)
+            differences = self._values(data, offset)
+            if key not in self.keyframes:
+                self.pending = self.pending[-(self.maxPending - 1):] + [(key, seconds, differences)]
+                return []
+            return [self._delta(key, seconds, differences)]
+        raise ValueError("unknown telemetry record type %d" % recordType)
+
+    def _values(self, data, offset):
+        values = []
+        for field in SCHEMA:
+            (value, offset) = decodeVarint(data, offset)
+            values.append(unzigzag(value))
+        return values
+
+    def _delta(self, key, seconds, differences):
+        (timestamp, base) = self.keyframes[key]
+        return self._sample(timestamp + seconds, [b + d for (b, d) in zip(base, differences)])
+
+    def _sample(self, timestamp, fixed):
+        sample = {name: value / scale if scale != 1 else value for (value, (name, scale)) in zip(fixed, SCHEMA)}
+        sample['timestamp'] = timestamp
+        return sample
@@ -0,0 +1,43 @@
+import os, sys, random
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fountain import *
+
+SYMBOL_SIZE = 49
+DATA = bytes(random.Random(1).getrandbits(8) for _ in range(1000))
+
+def test_source_symbols_alone_decode():
+    enc = FountainEncoder(DATA, 5, SYMBOL_SIZE)
+    dec = FountainDecoder()
+    done = [dec.addSymbol(symbol) for symbol in enc.symbols(enc.k)]
+    assert done[-1] and not any(done[:-1])
+    assert dec.data == DATA
+
+def test_decodes_with_lost_symbols():
+    enc = FountainEncoder(DATA, 9, SYMBOL_SIZE)
+    symbols = enc.symbols(enc.k * 2)
+    # every third source block is lost, repair symbols make up for them
+    received = [s for (index, s) in enumerate(symbols) if index >= enc.k or index % 3]
+    dec = FountainDecoder()
+    for symbol in received:
+        if dec.addSymbol(symbol):
+            break
+    assert dec.complete() and dec.data == DATA
+    assert dec.received <= enc.k + 10
+
+def test_new_transfer_resets_the_decoder():
+    dec = FountainDecoder()
+    old = FountainEncoder(bytes(len(DATA)), 1, SYMBOL_SIZE)
+    for symbol in old.symbols(old.k - 1):
+        dec.addSymbol(symbol)
+    enc = FountainEncoder(DATA, 2, SYMBOL_SIZE)
+    for symbol in enc.symbols(enc.k):
+        dec.addSymbol(symbol)
+    assert dec.data == DATA
+
+def test_short_and_oversized_data():
+    enc = FountainEncoder(b'abc', 0, SYMBOL_SIZE)
+    dec = FountainDecoder()
+    assert dec.addSymbol(enc.symbols(1)[0]) and dec.data == b'abc'
+    with pytest.raises(ValueError):
+        FountainEncoder(bytes(0x10000), 0, SYMBOL_SIZE)
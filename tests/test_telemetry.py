@@ -0,0 +1,57 @@
+import os, sys
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from telemetry import *
+
+VALUES = [51.5012345, -0.1234567, 1234.5, 0x34, 21.25, 1013.25, 45.5, 120, 48, 1234.6, 1.25]
+
+def encoder(tmp_path, name='epoch.json', **kwargs):
+    return TelemetryEncoder(epochFile=str(tmp_path / name), **kwargs)
+
+def assertSample(sample, values, timestamp):
+    assert sample['timestamp'] == timestamp
+    for ((name, scale), value) in zip(SCHEMA, values):
+        assert abs(sample[name] - value) <= 0.5 / scale
+
+def test_round_trip_with_negative_deltas(tmp_path):
+    enc = encoder(tmp_path, keyframeInterval=4)
+    dec = TelemetryDecoder()
+    for i in range(10):
+        values = [v - i * 3.7 if isinstance(v, float) else v for v in VALUES]
+        (sample,) = dec.decode(enc.encode(values, 1000 + i))
+        assertSample(sample, values, 1000 + i)
+
+def test_deltas_wait_for_their_keyframe(tmp_path):
+    enc = encoder(tmp_path)
+    records = [enc.encode(VALUES, 1000 + i) for i in range(3)]
+    dec = TelemetryDecoder()
+    assert dec.decode(records[2]) == []
+    assert dec.decode(records[1]) == []
+    samples = dec.decode(records[0])
+    assert sorted(s['timestamp'] for s in samples) == [1000, 1001, 1002]
+
+def test_delta_from_before_a_restart_uses_its_own_epoch(tmp_path):
+    before = encoder(tmp_path)
+    records = [before.encode(VALUES, 1000 + i) for i in range(2)]
+    after = encoder(tmp_path)
+    assert after.epoch != before.epoch
+    dec = TelemetryDecoder()
+    # the new keyframe has the same id as the old one
+    dec.decode(after.encode([0.0] * len(VALUES), 2000))
+    assert dec.decode(records[1]) == []
+    (keyframe, delta) = dec.decode(records[0])
+    assertSample(delta, VALUES, 1001)
+
+def test_rejects_other_codec_versions():
+    with pytest.raises(ValueError):
+        TelemetryDecoder().decode(bytes([0x10, 0, 0]))
+
+def test_delta_retried_after_many_keyframes_still_decodes(tmp_path):
+    enc = encoder(tmp_path, keyframeInterval=1)
+    records = [enc.encode(VALUES, 1000 + i) for i in range(40)]
+    dec = TelemetryDecoder()
+    for record in records:
+        dec.decode(record)
+    # records[1] is the delta on the first keyframe, arriving again much later
+    (sample,) = dec.decode(records[1])
+    assert sample['timestamp'] == 1001
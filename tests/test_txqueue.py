@@ -0,0 +1,69 @@
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from txqueue import *
+
+def newQueue(tmp_path, **kwargs):
+    return TransmitQueue(str(tmp_path / 'data.db'), archivePath=str(tmp_path / 'archive.db'), **kwargs)
+
+def test_ids_of_dropped_records_are_not_reused(tmp_path):
+    queue = newQueue(tmp_path)
+    queue.enqueue([(b'telemetry', RECORD_DATA)])
+    tiles = queue.enqueue([(b'tile', RECORD_TILE)] * 3)
+    queue.dropKind(RECORD_TILE)
+    ids = queue.enqueue([(b'next', RECORD_TILE)])
+    assert ids[0] > max(tiles)
+    # a late ack for a dropped tile must not ack the new record
+    assert not queue.ack(tiles[0] & 0xffff)
+    assert queue.count(RECORD_TILE) == 1
+    queue.close()
+
+def test_ids_survive_a_restart(tmp_path):
+    queue = newQueue(tmp_path)
+    dropped = queue.enqueue([(b'tile', RECORD_TILE)] * 3)
+    queue.dropKind(RECORD_TILE)
+    queue.close()
+    queue = newQueue(tmp_path)
+    assert queue.enqueue([(b'data', RECORD_DATA)])[0] > max(dropped)
+    queue.close()
+
+def test_take_fills_the_space_and_retries_unacked(tmp_path):
+    queue = newQueue(tmp_path, retryTimeout=10.0)
+    queue.enqueue([(bytes(10), RECORD_DATA)] * 3)
+    first = queue.take(25, overhead=2, now=100.0)
+    assert len(first) == 2
+    second = queue.take(25, overhead=2, now=100.0)
+    assert len(second) == 1
+    assert queue.take(25, overhead=2, now=105.0) == []
+    assert queue.ack(first[0].wireId)
+    again = queue.take(100, overhead=2, now=111.0)
+    assert sorted(r.id for r in again) == sorted([first[1].id, second[0].id])
+    queue.close()
+
+def test_split_pieces_survive_a_restart(tmp_path):
+    queue = newQueue(tmp_path)
+    (id,) = queue.enqueue([(bytes(range(40)), RECORD_CHUNK)])
+    split = lambda record, size: (record.data[:size], record.data[size:])
+    (piece,) = queue.take(20, overhead=4, split=split, now=0.0)
+    assert piece.id > id and piece.data == bytes(range(16))
+    queue.close()
+    queue = newQueue(tmp_path)
+    data = sorted((r.id, r.data) for r in queue.pending(RECORD_CHUNK))
+    assert data == [(id, bytes(range(16, 40))), (piece.id, bytes(range(16)))]
+    queue.close()
+
+def test_acked_records_are_not_reloaded(tmp_path):
+    queue = newQueue(tmp_path)
+    ids = queue.enqueue([(b'a', RECORD_DATA), (b'b', RECORD_DATA)])
+    assert queue.ack(ids[0] & 0xffff)
+    queue.close()
+    queue = newQueue(tmp_path)
+    assert [r.id for r in queue.pending(RECORD_DATA)] == [ids[1]]
+    queue.close()
+
+def test_unreliable_records_are_sent_once(tmp_path):
+    queue = newQueue(tmp_path, unreliable=(RECORD_FEC,), retryTimeout=1.0)
+    queue.enqueue([(b'symbol', RECORD_FEC)])
+    assert len(queue.take(50, now=0.0)) == 1
+    assert queue.take(50, now=10.0) == []
+    assert queue.count(RECORD_FEC) == 0
+    queue.close()
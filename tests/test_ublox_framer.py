@@ -0,0 +1,72 @@
+import os, sys, random
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ublox import *
+
+NAV_PVT = (0x01, 0x07)
+NAV_SAT = (0x01, 0x35)
+
+def frame(msgClass, msgId, payload):
+    body = bytes([msgClass, msgId, len(payload) & 0xff, len(payload) >> 8]) + payload
+    return bytes([PREAMBLE1, PREAMBLE2]) + body + bytes(ubx_checksum(body))
+
+def popAll(framer, accept=None):
+    frames = []
+    while True:
+        data = framer.pop_frame(accept)
+        if data is None:
+            return frames
+        frames.append(data)
+
+def test_frames_between_garbage():
+    pvt = frame(*NAV_PVT, bytes(range(92)))
+    sat = frame(*NAV_SAT, bytes(20))
+    # stray preamble bytes and a preamble with a broken checksum among the noise
+    garbage = bytes([PREAMBLE1, 0x00, PREAMBLE2]) + frame(*NAV_SAT, bytes(4))[:-1] + b'\x00'
+    framer = UBloxFramer()
+    framer.feed(b'$GPGGA,noise\r\n' + pvt + garbage + sat)
+    assert popAll(framer) == [pvt, sat]
+    assert framer.discarded > 0
+    assert len(framer) == 0
+
+def test_frames_split_across_reads():
+    frames = [frame(*NAV_PVT, bytes([n]) * 92) for n in range(5)]
+    stream = b''.join(frames)
+    rng = random.Random(3)
+    framer = UBloxFramer()
+    received = []
+    offset = 0
+    while offset < len(stream):
+        size = rng.randint(1, 40)
+        framer.feed(stream[offset:offset+size])
+        offset += size
+        received.extend(popAll(framer))
+    assert received == frames
+    assert framer.discarded == 0
+
+def test_random_garbage_never_yields_a_bad_frame():
+    rng = random.Random(7)
+    framer = UBloxFramer()
+    framer.feed(bytes(rng.getrandbits(8) for _ in range(20000)))
+    for data in popAll(framer):
+        assert bytes(ubx_checksum(data[2:-2])) == data[-2:]
+
+def test_rejected_frame_waits_for_the_next_preamble():
+    pvt = frame(*NAV_PVT, bytes(92))
+    # a frame of an unwanted type whose length field is wrong, cut off at its claimed end
+    bogus = bytes([PREAMBLE1, PREAMBLE2, NAV_SAT[0], NAV_SAT[1], 4, 0]) + bytes(4)
+    framer = UBloxFramer()
+    framer.feed(bogus + pvt[:4])
+    assert popAll(framer, accept={NAV_PVT}) == []
+    framer.feed(pvt[4:])
+    assert popAll(framer, accept={NAV_PVT}) == [pvt]
+    assert framer.skipped == 0
+
+def test_unwanted_frames_are_skipped():
+    pvt = frame(*NAV_PVT, bytes(92))
+    sat = frame(*NAV_SAT, bytes(20))
+    framer = UBloxFramer()
+    framer.feed(sat + pvt + sat)
+    assert popAll(framer, accept={NAV_PVT}) == [pvt]
+    framer.feed(pvt)
+    assert popAll(framer, accept={NAV_PVT}) == [pvt]
+    assert framer.skipped == 2
@@ -0,0 +1,29 @@
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from uplink import *
+
+# most records one downlink frame can carry: 4 byte record header and 1 byte of data each
+MAX_FRAME_RECORDS = MAX_UPLINK_SIZE // 5
+
+def fullNack(maxRanges):
+    return (7, 40000, 40000, [(n * 100, 50) for n in range(maxRanges)])
+
+def test_worst_case_uplink_fits_a_frame():
+    ids = list(range(MAX_FRAME_RECORDS))
+    packet = encodeUplink(ids, fecDone=7, linkReport=100, rateAck=3, nack=fullNack)
+    assert len(packet) <= MAX_UPLINK_SIZE
+    (messages, used) = parseUplink(packet)
+    assert used == len(packet)
+    kinds = [kind for (kind, value) in messages]
+    assert kinds == [ACK_FRAME, FEC_DONE, LINK_REPORT, RATE_ACK, NACK_RANGES]
+    assert list(messages[0][1]) == ids
+
+def test_nack_takes_the_space_left():
+    packet = encodeUplink(nack=fullNack)
+    assert len(packet) <= MAX_UPLINK_SIZE
+    (messages, used) = parseUplink(packet)
+    assert len(messages[0][1][3]) == (MAX_UPLINK_SIZE - 1 - NACK_HEADER.size) // NACK_RANGE.size
+
+def test_record_acks():
+    (messages, used) = parseUplink(encodeUplink([1, 0x1234], recordAcks=True))
+    assert messages == [(ACK_RECORD, [1]), (ACK_RECORD, [0x1234])]
@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+
+import sqlite3, logging, heapq, time
+from threading import Lock
+
+# record types stored in the habdata.chunked column
+RECORD_DATA = 0
+RECORD_CHUNK = 1
+RECORD_TILE = 2
+RECORD_FEC = 3
+
+RETRY_TIMEOUT = 10.0 # until the round trip time has been measured
+MIN_RETRY_TIMEOUT = 1.0
+MAX_RETRY_TIMEOUT = 30.0
+ACK_FLUSH_INTERVAL = 1.0
+MAINTENANCE_INTERVAL = 30.0
+RETENTION_SECONDS = 600 # acked rows are kept this long before they are archived or deleted
+RETENTION_BATCH = 256
+VACUUM_PAGES = 64
+
+class QueueRecord:
+    __slots__ = ('id', 'wireId', 'data', 'kind', 'tries', 'nextRetry', 'lastSent', 'state')
+
+    def __init__(self, id, data, kind):
+        self.id = id
+        self.wireId = id & 0xffff # records are identified by 16 bits on air
+        self.data = bytes(data)
+        self.kind = kind
+        self.tries = 0
+        self.nextRetry = 0.0
+        self.lastSent = None
+        self.state = None
+
+class TransmitQueue:
+    '''outbound record queue held in memory and persisted in SQLite
+
+    Records ready to send are kept in a heap ordered like the old query
+    (record type, then newest first), and records waiting for their retry
+    time in a second heap ordered by that time, so picking the next record is
+    O(log n) with no disk access. Enqueues are committed to data.db (WAL mode)
+    before returning, one transaction per call. Acks are written back in
+    groups; losing some on power failure only causes a resend.
+
+    Acked rows are removed by maintain() in small batches once they are older
+    than the retention window, telemetry rows being copied to the archive
+    database first, and freed pages are returned with incremental vacuum so
+    data.db stays the size of the live backlog for the whole flight.
+
+    The retry timeout follows the measured round trip time the way TCP does
+    (smoothed RTT plus four times its deviation, RFC 6298), sampled only from
+    records acked after their first transmission.
+    '''
+    READY = 1
+    WAITING = 2
+
+    def __init__(self, path='data.db', retryTimeout=RETRY_TIMEOUT, archivePath='archive.db', retention=RETENTION_SECONDS, unreliable=()):
+        self.retryTimeout = retryTimeout
+        self.unreliable = frozenset(unreliable) # types that are sent once and never retried
+        self.srtt = None
+        self.rttvar = 0.0
+        self.retention = retention
+        self.archived = 0
+        self.deleted = 0
+        self.splits = 0
+        self.lock = Lock()
+        self.records = {} # wire id -> record
+        self.ready = []
+        self.waiting = []
+        self.pendingAcks = []
+        self.lastFlush = time.monotonic()
+        self.lastMaintenance = self.lastFlush
+        self.counts = {RECORD_DATA: 0, RECORD_CHUNK: 0, RECORD_TILE: 0, RECORD_FEC: 0}
+        self.unsent = {RECORD_DATA: 0, RECORD_CHUNK: 0, RECORD_TILE: 0, RECORD_FEC: 0}
+        self.bytes = 0
+        self.listener = None # called after records become due outside take(), e.g. to wake the transmit loop
+
+        self.dbConn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        if self.dbConn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            # only takes effect on an existing database after a full vacuum, done once
+            self.dbConn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            self.dbConn.execute("VACUUM")
+        self.dbConn.execute("PRAGMA journal_mode=WAL")
+        self.dbConn.execute("PRAGMA synchronous=FULL")
+        self.dbConn.execute("CREATE TABLE IF NOT EXISTS habdata(id INTEGER PRIMARY KEY, data BLOB NOT NULL, chunked INT DEFAULT 0 NOT NULL, created timestamp NOT NULL, ack INT DEFAULT 0 NOT NULL, lasttry timestamp NOT NULL);")
+        self.dbConn.execute("CREATE INDEX IF NOT EXISTS habdata_ack_created ON habdata(ack, created)")
+        self.dbConn.execute("CREATE INDEX IF NOT EXISTS habdata_pending ON habdata(chunked) WHERE ack = 0")
+        if archivePath is not None:
+            self.dbConn.execute("ATTACH DATABASE ? AS archive", [archivePath])
+            self.dbConn.execute("CREATE TABLE IF NOT EXISTS archive.habdata(id INTEGER PRIMARY KEY, data BLOB NOT NULL, created timestamp NOT NULL);")
+        self.archive = archivePath is not None
+        # highest id ever handed out, so ids of dropped or deleted rows are never reused
+        self.dbConn.execute("CREATE TABLE IF NOT EXISTS habdata_lastid(id INTEGER NOT NULL)")
+        if self.dbConn.execute("SELECT COUNT(*) FROM habdata_lastid").fetchone()[0] == 0:
+            last = self.dbConn.execute("SELECT COALESCE(MAX(id), 0) FROM main.habdata").fetchone()[0]
+            if self.archive:
+                last = max(last, self.dbConn.execute("SELECT COALESCE(MAX(id), 0) FROM archive.habdata").fetchone()[0])
+            self.dbConn.execute("INSERT INTO habdata_lastid(id) VALUES (?)", [last])
+        self.load()
+
+    def load(self):
+        # unacked records from before a restart are ready immediately
+        rows = self.dbConn.execute("SELECT id, data, chunked FROM habdata WHERE ack = 0 ORDER BY id").fetchall()
+        with self.lock:
+            for (id, data, kind) in rows:
+                self._add(QueueRecord(id, data, kind))
+        if rows:
+            logging.info("Loaded %d unacked records from queue" % len(rows))
+
+    def _add(self, record):
+        old = self.records.get(record.wireId)
+        if old is not None:
+            # 16 bit id wrapped onto a record that is still pending, the older one is dropped
+            self._remove(old)
+        self.records[record.wireId] = record
+        self.counts[record.kind] = self.counts.get(record.kind, 0) + 1
+        self.unsent[record.kind] = self.unsent.get(record.kind, 0) + 1
+        self.bytes += len(record.data)
+        record.state = self.READY
+        heapq.heappush(self.ready, (record.kind, -record.id, record.wireId, record.id))
+
+    def _remove(self, record):
+        # heap entries of removed records are discarded lazily
+        del self.records[record.wireId]
+        self.counts[record.kind] -= 1
+        if record.tries == 0:
+            self.unsent[record.kind] -= 1
+        self.bytes -= len(record.data)
+        record.state = None
+
+    def _current(self, wireId, id):
+        record = self.records.get(wireId)
+        if record is None or record.id != id:
+            return None
+        return record
+
+    def _newIds(self, cursor, count):
+        # called inside the caller's transaction, returns the first of count new ids
+        first = cursor.execute("SELECT id FROM habdata_lastid").fetchone()[0] + 1
+        cursor.execute("UPDATE habdata_lastid SET id = ?", [first + count - 1])
+        return first
+
+    def enqueue(self, items):
+        '''add a list of (data, kind) records in one transaction, returns their ids'''
+        with self.lock:
+            cursor = self.dbConn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                # ids are assigned here so the whole batch is one executemany
+                first = self._newIds(cursor, len(items))
+                ids = range(first, first + len(items))
+                cursor.executemany("INSERT INTO habdata(id, data, chunked, created, lasttry) VALUES (?, ?, ?, datetime('now'), datetime('now'));", [(id, data, kind) for (id, (data, kind)) in zip(ids, items)])
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+            for ((data, kind), id) in zip(items, ids):
+                self._add(QueueRecord(id, data, kind))
+        self._notify()
+        return list(ids)
+
+    def _notify(self):
+        if self.listener is not None:
+            self.listener()
+
+    def _promote(self, now):
+        # records whose retry time has passed go back to the ready heap
+        while self.waiting and self.waiting[0][0] <= now:
+            (nextRetry, wireId, id) = heapq.heappop(self.waiting)
+            record = self._current(wireId, id)
+            if record is not None and record.state == self.WAITING and record.nextRetry == nextRetry:
+                record.state = self.READY
+                heapq.heappush(self.ready, (record.kind, -record.id, record.wireId, record.id))
+
+    def _sent(self, record, now):
+        # the record's entry in the ready heap, if any, goes stale
+        if record.tries == 0:
+            self.unsent[record.kind] -= 1
+        record.tries += 1
+        record.lastSent = now
+        if record.kind in self.unreliable:
+            self._remove(record)
+            self.pendingAcks.append((record.id,))
+            return
+        record.nextRetry = now + self.retryTimeout
+        record.state = self.WAITING
+        heapq.heappush(self.waiting, (record.nextRetry, record.wireId, record.id))
+
+    def _split(self, record, size, split):
+        # replace record by a new record holding its first size bytes and the rest
+        pieces = split(record, size)
+        if pieces is None:
+            return None
+        (head, tail) = pieces
+        cursor = self.dbConn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            id = self._newIds(cursor, 1)
+            cursor.execute("INSERT INTO habdata(id, data, chunked, created, lasttry) VALUES (?, ?, ?, datetime('now'), datetime('now'));", [id, head, record.kind])
+            cursor.execute("UPDATE habdata SET data = ? WHERE id = ?", [tail, record.id])
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        self.bytes += len(tail) - len(record.data)
+        record.data = bytes(tail)
+        piece = QueueRecord(id, head, record.kind)
+        self._add(piece)
+        self.splits += 1
+        return piece
+
+    def take(self, space, overhead=0, split=None, scanLimit=32, now=None):
+        '''fill space bytes with due records, returned in send order
+
+        Up to scanLimit due records are considered in send order and each one
+        that still fits is taken, so a large record at the head does not leave
+        the frame empty while smaller ones wait. If space is left over, the
+        first unsent record that did not fit is offered to split(record, size),
+        which returns the data for a piece of exactly size bytes and for the
+        remainder, or None. Each record costs overhead bytes on top of its
+        data. Taken records wait retryTimeout seconds for an ack before they
+        are due again.
+        '''
+        now = time.monotonic() if now is None else now
+        records = []
+        with self.lock:
+            self._promote(now)
+            candidates = []
+            while self.ready and len(candidates) < scanLimit:
+                entry = heapq.heappop(self.ready)
+                record = self._current(entry[2], entry[3])
+                if record is not None and record.state == self.READY:
+                    candidates.append((entry, record))
+
+            remainder = None
+            for (entry, record) in candidates:
+                if len(record.data) + overhead <= space:
+                    space -= len(record.data) + overhead
+                    self._sent(record, now)
+                    records.append(record)
+                else:
+                    if remainder is None and record.tries == 0:
+                        remainder = record
+                    heapq.heappush(self.ready, entry)
+
+            if split is not None and remainder is not None and space > overhead:
+                piece = self._split(remainder, space - overhead, split)
+                if piece is not None:
+                    self._sent(piece, now)
+                    records.append(piece)
+        return records
+
+    def _sampleRtt(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2.0
+        else:
+            self.rttvar += 0.25 * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += 0.125 * (rtt - self.srtt)
+        self.retryTimeout = min(MAX_RETRY_TIMEOUT, max(MIN_RETRY_TIMEOUT, self.srtt + 4.0 * self.rttvar))
+
+    def ack(self, wireId):
+        return self.ackMany([wireId]) > 0
+
+    def ackMany(self, wireIds, now=None, sampleRtt=True):
+        '''apply a group of acks, returns how many matched a pending record'''
+        now = time.monotonic() if now is None else now
+        acked = 0
+        with self.lock:
+            for wireId in wireIds:
+                record = self.records.get(wireId)
+                if record is None:
+                    continue
+                if sampleRtt and record.tries == 1 and record.lastSent is not None:
+                    self._sampleRtt(now - record.lastSent)
+                self._remove(record)
+                self.pendingAcks.append((record.id,))
+                acked += 1
+        return acked
+
+    def pending(self, kind):
+        '''snapshot of the pending records of a type'''
+        with self.lock:
+            return [r for r in self.records.values() if r.kind == kind]
+
+    def expedite(self, records, now=None):
+        '''make sent records due again without waiting for their retry timeout'''
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            for record in records:
+                if record.state == self.WAITING:
+                    record.state = self.READY
+                    heapq.heappush(self.ready, (record.kind, -record.id, record.wireId, record.id))
+        self._notify()
+
+    def nextDue(self, now=None):
+        '''time at which take() next has a record to return, None while nothing is pending'''
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            while self.ready:
+                entry = self.ready[0]
+                record = self._current(entry[2], entry[3])
+                if record is not None and record.state == self.READY:
+                    return now
+                heapq.heappop(self.ready)
+            # a stale head only makes the caller look again early
+            return self.waiting[0][0] if self.waiting else None
+
+    def dropKind(self, kind):
+        '''forget every pending record of a type'''
+        with self.lock:
+            for record in [r for r in self.records.values() if r.kind == kind]:
+                self._remove(record)
+            self.dbConn.execute("DELETE FROM habdata WHERE chunked = ? AND ack = 0", [kind])
+
+    def flush(self, force=False):
+        '''write grouped acks back to the database'''
+        now = time.monotonic()
+        if not force and now - self.lastFlush < ACK_FLUSH_INTERVAL:
+            return
+        self.lastFlush = now
+        with self.lock:
+            if not self.pendingAcks:
+                return
+            acks = self.pendingAcks
+            self.pendingAcks = []
+            cursor = self.dbConn.cursor()
+            cursor.execute("BEGIN")
+            try:
+                cursor.executemany("UPDATE habdata SET ack = 1 WHERE id = ?", acks)
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                # the acks are written with the next flush
+                self.pendingAcks = acks + self.pendingAcks
+                raise
+
+    def maintain(self, force=False):
+        '''archive or delete one batch of expired acked rows and vacuum freed pages'''
+        now = time.monotonic()
+        if not force and now - self.lastMaintenance < MAINTENANCE_INTERVAL:
+            return 0
+        self.lastMaintenance = now
+        with self.lock:
+            cursor = self.dbConn.cursor()
+            rows = cursor.execute("SELECT id FROM habdata WHERE ack = 1 and created <= datetime('now', ?) ORDER BY ack, created LIMIT ?", ["-%d seconds" % self.retention, RETENTION_BATCH]).fetchall()
+            if rows:
+                where = "id IN (%s)" % ",".join("?" * len(rows))
+                ids = [row[0] for row in rows]
+                cursor.execute("BEGIN")
+                try:
+                    if self.archive:
+                        # a commit across two WAL databases is not atomic, so rows archived
+                        # before a crash may be copied again
+                        cursor.execute("INSERT OR IGNORE INTO archive.habdata(id, data, created) SELECT id, data, created FROM main.habdata WHERE chunked = %d and %s" % (RECORD_DATA, where), ids)
+                        self.archived += max(0, cursor.rowcount)
+                    cursor.execute("DELETE FROM main.habdata WHERE " + where, ids)
+                    cursor.execute("COMMIT")
+                except Exception:
+                    cursor.execute("ROLLBACK")
+                    raise
+                self.deleted += len(rows)
+            # the pragma frees pages one step at a time, so its rows must be consumed
+            cursor.execute("PRAGMA main.incremental_vacuum(%d)" % VACUUM_PAGES).fetchall()
+            return len(rows)
+
+    def count(self, kind):
+        return self.counts.get(kind, 0)
+
+    def unsentCount(self, kind):
+        return self.unsent.get(kind, 0)
+
+    def pendingBytes(self):
+        return self.bytes
+
+    def close(self):
+        self.flush(force=True)
+        self.dbConn.close()
+        self.dbConn = None
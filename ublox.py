@@ -9,11 +9,25 @@ Released under GNU GPL version 3 or later
 
 import struct
 from datetime import datetime
+from operator import mul
 import time, os
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # protocol constants
 PREAMBLE1 = 0xb5
 PREAMBLE2 = 0x62
+PREAMBLE = bytes([PREAMBLE1, PREAMBLE2])
+
+# framing limits
+MAX_PAYLOAD_LENGTH = 2048
+READ_BLOCK_SIZE = 4096
+
+# buffers at least this long are checksummed with numpy when available
+NUMPY_CHECKSUM_MIN = 64
 
 # message classes
 CLASS_NAV = 0x01
@@ -36,6 +50,7 @@ MSG_NAV_POSLLH    = 0x2
 MSG_NAV_STATUS    = 0x3
 MSG_NAV_DOP       = 0x4
 MSG_NAV_SOL       = 0x6
+MSG_NAV_PVT       = 0x7
 MSG_NAV_POSUTM    = 0x8
 MSG_NAV_VELNED    = 0x12
 MSG_NAV_VELECEF   = 0x11
@@ -165,8 +180,8 @@ class UBloxError(Exception):
 
 class UBloxAttrDict(dict):
     '''allow dictionary members as attributes'''
-    def __init__(self):
-        dict.__init__(self)
+    def __init__(self, *args):
+        dict.__init__(self, *args)
 
     def __getattr__(self, name):
         try:
@@ -181,6 +196,30 @@ class UBloxAttrDict(dict):
         else:
             self.__setitem__(name, value)
 
+def ubx_checksum_python(data):
+    '''return the UBX Fletcher checksum tuple for a buffer
+
+    ck_a is the byte sum and ck_b the sum of the running ck_a values, which is
+    every byte weighted by the number of bytes from it to the end.
+    '''
+    n = len(data)
+    ck_a = sum(data) & 0xFF
+    ck_b = sum(map(mul, data, range(n, 0, -1))) & 0xFF
+    return (ck_a, ck_b)
+
+def ubx_checksum_numpy(data):
+    '''return the UBX Fletcher checksum tuple for a buffer using numpy'''
+    a = numpy.frombuffer(data, dtype=numpy.uint8).astype(numpy.int64)
+    ck_a = int(a.sum()) & 0xFF
+    ck_b = int(numpy.dot(a, numpy.arange(len(a), 0, -1, dtype=numpy.int64))) & 0xFF
+    return (ck_a, ck_b)
+
+def ubx_checksum(data):
+    '''return the UBX Fletcher checksum tuple for a buffer'''
+    if numpy is not None and len(data) >= NUMPY_CHECKSUM_MIN:
+        return ubx_checksum_numpy(data)
+    return ubx_checksum_python(data)
+
 def ArrayParse(field):
     '''parse an array descriptor'''
     arridx = field.find('[')
@@ -199,62 +238,91 @@ class UBloxDescriptor:
         self.count_field = count_field
         self.format2 = format2
         self.fields2 = fields2
+        self._compile()
+
+    def _compile(self):
+        '''precompile the struct objects and field index maps used by unpack/pack'''
+        self._parsed = [ArrayParse(f) for f in self.fields]
+        self._blocks = []
+        self._error = None
+        fields = self._parsed[:]
+        for fmt in self.msg_format.split(','):
+            s = struct.Struct(fmt)
+            nvalues = len(s.unpack(bytes(s.size)))
+            plan = []
+            i = 0
+            while i < nvalues:
+                if not fields:
+                    self._error = "%s FIELD_MISMATCH" % self.name
+                    break
+                (fieldname, alen) = fields.pop(0)
+                if alen == -1:
+                    plan.append((fieldname, i, None))
+                    i += 1
+                else:
+                    plan.append((fieldname, i, i + alen))
+                    i += alen
+            # blocks without arrays decode with a single zip over the values
+            names = tuple(p[0] for p in plan) if all(p[2] is None for p in plan) else None
+            self._blocks.append((s, names, tuple(plan)))
+
+        self._struct2 = struct.Struct(self.format2) if self.format2 is not None else None
+        self._struct_full = struct.Struct(self.msg_format.replace(',', ''))
+        self._struct_first = self._blocks[0][0]
 
     def unpack(self, msg):
         '''unpack a UBloxMessage, creating the .fields and ._recs attributes in msg'''
-        msg._fields = {}
-
-        # unpack main message blocks. A comm
-        formats = self.msg_format.split(',')
-        buf = msg._buf[6:-2]
-        count = 0
+        if self._error is not None:
+            raise UBloxError(self._error)
+        fields = {}
+        msg._fields = fields
         msg._recs = []
-        fields = self.fields[:]
 
-        for fmt in formats:
-            size1 = struct.calcsize(fmt)
-            if size1 > len(buf):
-                raise UBloxError("%s INVALID_SIZE1=%u" % (self.name, len(buf)))
-            f1 = list(struct.unpack(fmt, buf[:size1]))
-            i = 0
-            while i < len(f1):
-                field = fields.pop(0)
-                (fieldname, alen) = ArrayParse(field)
-                if alen == -1:
-                    msg._fields[fieldname] = f1[i]
-                    if self.count_field == fieldname:
-                        count = int(f1[i])
-                    i += 1
-                else:
-                    msg._fields[fieldname] = [0]*alen
-                    for a in range(alen):
-                        msg._fields[fieldname][a] = f1[i]
-                        i += 1
-            buf = buf[size1:]
-            if len(buf) == 0:
+        # unpack main message blocks. Blocks after the first are optional
+        buf = msg._buf
+        offset = 6
+        end = len(buf) - 2
+        for (s, names, plan) in self._blocks:
+            if offset + s.size > end:
+                raise UBloxError("%s INVALID_SIZE1=%u" % (self.name, end - offset))
+            values = s.unpack_from(buf, offset)
+            offset += s.size
+            if names is not None:
+                fields.update(zip(names, values))
+            else:
+                for (fieldname, start, stop) in plan:
+                    if stop is None:
+                        fields[fieldname] = values[start]
+                    else:
+                        fields[fieldname] = list(values[start:stop])
+            if offset == end:
                 break
 
+        remaining = end - offset
+        count = 0
         if self.count_field == '_remaining':
-            count = len(buf) / struct.calcsize(self.format2)
+            count = remaining // self._struct2.size
+        elif self.count_field is not None and self.count_field in fields:
+            count = int(fields[self.count_field])
 
         if count == 0:
             msg._unpacked = True
-            if len(buf) != 0:
-                raise UBloxError("EXTRA_BYTES=%u" % len(buf))
+            if remaining != 0:
+                raise UBloxError("EXTRA_BYTES=%u" % remaining)
             return
 
-        size2 = struct.calcsize(self.format2)
-        for c in range(count):
-            r = UBloxAttrDict()
-            if size2 > len(buf):
-                raise UBloxError("INVALID_SIZE=%u, " % len(buf))
-            f2 = list(struct.unpack(self.format2, buf[:size2]))
-            for i in range(len(self.fields2)):
-                r[self.fields2[i]] = f2[i]
-            buf = buf[size2:]
-            msg._recs.append(r)
-        if len(buf) != 0:
-            raise UBloxError("EXTRA_BYTES=%u" % len(buf))
+        size2 = self._struct2.size
+        if count * size2 > remaining:
+            raise UBloxError("INVALID_SIZE=%u, " % remaining)
+        fields2 = self.fields2
+        recs = msg._recs
+        view = memoryview(buf)[offset:offset + count * size2]
+        for f2 in self._struct2.iter_unpack(view):
+            recs.append(UBloxAttrDict(zip(fields2, f2)))
+        view.release()
+        remaining -= count * size2
+        if remaining != 0:
+            raise UBloxError("EXTRA_BYTES=%u" % remaining)
         msg._unpacked = True
 
     def pack(self, msg, msg_class=None, msg_id=None):
@@ -264,38 +332,31 @@ class UBloxDescriptor:
             msg_class = msg.msg_class()
         if msg_id is None:
             msg_id = msg.msg_id()
-        msg._buf = ''
+        msg._buf = b''
 
-        fields = self.fields[:]
-        for f in fields:
-            (fieldname, alen) = ArrayParse(f)
+        for (fieldname, alen) in self._parsed:
             if not fieldname in msg._fields:
                 break
             if alen == -1:
                 f1.append(msg._fields[fieldname])
             else:
-                for a in range(alen):
-                    f1.append(msg._fields[fieldname][a])
+                f1.extend(msg._fields[fieldname][:alen])
         try:
             # try full length message
-            fmt = self.msg_format.replace(',', '')
-            msg._buf = struct.pack(fmt, *tuple(f1))
+            body = self._struct_full.pack(*f1)
         except Exception as e:
             # try without optional part
-            fmt = self.msg_format.split(',')[0]
-            msg._buf = struct.pack(fmt, *tuple(f1))
+            body = self._struct_first.pack(*f1)
 
-        length = len(msg._buf)
+        length = len(body)
         if msg._recs:
-            length += len(msg._recs) * struct.calcsize(self.format2)
-        header = struct.pack('<BBBBH', PREAMBLE1, PREAMBLE2, msg_class, msg_id, length)
-        msg._buf = header + msg._buf
+            length += len(msg._recs) * self._struct2.size
+        parts = [struct.pack('<BBBBH', PREAMBLE1, PREAMBLE2, msg_class, msg_id, length), body]
 
+        fields2 = self.fields2
         for r in msg._recs:
-            f2 = []
-            for f in self.fields2:
-                f2.append(r[f])
-            msg._buf += struct.pack(self.format2, *tuple(f2))
+            parts.append(self._struct2.pack(*[r[f] for f in fields2]))
+        msg._buf = b''.join(parts)
         msg._buf += struct.pack('<BB', *msg.checksum(data=msg._buf[2:]))
 
     def format(self, msg):
@@ -303,8 +364,7 @@ class UBloxDescriptor:
         if not msg._unpacked:
             self.unpack(msg)
         ret = self.name + ': '
-        for f in self.fields:
-            (fieldname, alen) = ArrayParse(f)
+        for (f, (fieldname, alen)) in zip(self.fields, self._parsed):
             if not fieldname in msg._fields:
                 continue
             v = msg._fields[fieldname]
@@ -379,6 +439,13 @@ msg_types = {
                                                   ['iTOW', 'fTOW', 'week', 'gpsFix', 'flags', 'ecefX', 'ecefY', 'ecefZ',
                                                    'pAcc', 'ecefVX', 'ecefVY', 'ecefVZ', 'sAcc', 'pDOP', 'reserved1',
                                                    'numSV', 'reserved2']),
+    (CLASS_NAV, MSG_NAV_PVT)    : UBloxDescriptor('NAV_PVT',
+                                                  '<IHBBBBBBIiBBBBiiiiIIiiiiiIIH6BihH',
+                                                  ['iTOW', 'year', 'month', 'day', 'hour', 'min', 'sec', 'validFlags', 'tAcc',
+                                                   'nano', 'fixType', 'flags', 'flags2', 'numSV', 'lon', 'lat', 'height',
+                                                   'hMSL', 'hAcc', 'vAcc', 'velN', 'velE', 'velD', 'gSpeed', 'headMot',
+                                                   'sAcc', 'headAcc', 'pDOP', 'reserved1[6]', 'headVeh', 'magDec',
+                                                   'magAcc']),
     (CLASS_NAV, MSG_NAV_POSUTM) : UBloxDescriptor('NAV_POSUTM',
                                                   '<Iiiibb',
                                                   ['iTOW', 'East', 'North', 'Alt', 'Zone', 'Hem']),
@@ -450,6 +517,7 @@ msg_types = {
                                                   ['chn', 'svid', 'dwrd[10]']),
     (CLASS_AID, MSG_AID_ALM)   : UBloxDescriptor('AID_ALM',
                                                   '<II',
+                                                  ['svid', 'week'],
                                                  '_remaining',
                                                  'I',
                                                  ['dwrd']),
@@ -506,6 +574,10 @@ msg_types = {
 }
 
 
+# message types that UBlox.special_handling() must always see
+SPECIAL_HANDLING_TYPES = frozenset([(CLASS_CFG, MSG_CFG_NAV5), (CLASS_CFG, MSG_CFG_NAVX5)])
+
+
 class UBloxMessage:
     '''UBlox message class - holds a UBX binary message'''
     def __init__(self):
@@ -513,6 +585,8 @@ class UBloxMessage:
         self._fields = {}
         self._recs = []
         self._unpacked = False
+        self._valid_cache = None
+        self._received = None
         self.debug_level = 0
 
     def __str__(self):
@@ -525,10 +599,19 @@ class UBloxMessage:
         return 'UBloxMessage(UNKNOWN %s, %u)' % (str(type), self.msg_length())
 
     def __getattr__(self, name):
-        '''allow access to message fields'''
+        '''allow access to message fields, decoding the message on first use'''
+        if name.startswith('_'):
+            raise AttributeError(name)
         try:
             return self._fields[name]
         except KeyError:
+            if not self._unpacked and len(self._buf) >= 8:
+                # hasattr() and getattr() with a default expect AttributeError, not a decode failure
+                try:
+                    self.unpack()
+                except UBloxError as e:
+                    raise AttributeError('%s: %s' % (name, e))
+                return self.__getattr__(name)
             if name == 'recs':
                 return self._recs
             raise AttributeError(name)
@@ -542,6 +625,8 @@ class UBloxMessage:
 
     def have_field(self, name):
         '''return True if a message contains the given field'''
+        if not self._unpacked and len(self._buf) >= 8:
+            self.unpack()
         return name in self._fields
 
     def debug(self, level, msg):
@@ -610,31 +695,29 @@ class UBloxMessage:
 
     def add(self, newbytes):
         '''add some bytes to a message'''
-        self._buf += newbytes
+        self._buf += bytes(newbytes)
         while not self.valid_so_far() and len(self._buf) > 0:
-            '''handle corrupted streams'''
-            self._buf = self._buf[1:]
+            '''handle corrupted streams by jumping to the next preamble'''
+            idx = self._buf.find(PREAMBLE, 1)
+            if idx != -1:
+                self._buf = self._buf[idx:]
+            elif self._buf[-1] == PREAMBLE1:
+                self._buf = self._buf[-1:]
+            else:
+                self._buf = b""
         if self.needed_bytes() < 0:
-            self._buf = ""
+            self._buf = b""
 
     def checksum(self, data=None):
         '''return a checksum tuple for a message'''
         if data is None:
-            data = self._buf[2:-2]
-        cs = 0
-        ck_a = 0
-        ck_b = 0
-        for i in data:
-            ck_a = (ck_a + i) & 0xFF
-            ck_b = (ck_b + ck_a) & 0xFF
-        return (ck_a, ck_b)
+            data = memoryview(self._buf)[2:-2]
+        return ubx_checksum(data)
 
     def valid_checksum(self):
         '''check if the checksum is OK'''
         (ck_a, ck_b) = self.checksum()
-        d = self._buf[2:-2]
-        (ck_a2, ck_b2) = struct.unpack('<BB', self._buf[-2:])
-        return ck_a == ck_a2 and ck_b == ck_b2
+        return ck_a == self._buf[-2] and ck_b == self._buf[-1]
 
     def needed_bytes(self):
         '''return number of bytes still needed'''
@@ -643,8 +726,124 @@ class UBloxMessage:
         return self.msg_length() + 8 - len(self._buf)
 
     def valid(self):
-        '''check if a message is valid'''
-        return len(self._buf) >= 8 and self.needed_bytes() == 0 and self.valid_checksum()
+        '''check if a message is valid, caching the result for a complete buffer'''
+        buf = self._buf
+        cache = self._valid_cache
+        if cache is not None and cache[0] is buf:
+            return cache[1]
+        if len(buf) < 8 or self.needed_bytes() != 0:
+            return False
+        result = self.valid_checksum()
+        self._valid_cache = (buf, result)
+        return result
+
+
+class UBloxFramer:
+    '''streaming UBX framer over a reusable receive buffer
+
+    Bytes are appended with feed(); complete frames with a valid checksum are
+    taken off the front with pop_frame() or frames(). Garbage is skipped by
+    searching for the next preamble, so resync costs stay linear in the input.
+    '''
+    def __init__(self, max_payload=MAX_PAYLOAD_LENGTH):
+        self._buf = bytearray()
+        self._start = 0
+        self.max_payload = max_payload
+        self.discarded = 0
+        self.skipped = 0
+
+    def __len__(self):
+        '''number of buffered bytes not yet consumed'''
+        return len(self._buf) - self._start
+
+    def feed(self, data):
+        '''append received bytes, compacting consumed space first'''
+        if self._start:
+            if self._start == len(self._buf):
+                self._buf.clear()
+            elif self._start > len(self._buf) // 2:
+                del self._buf[:self._start]
+            else:
+                self._buf += data
+                return
+            self._start = 0
+        self._buf += data
+
+    def reset(self):
+        '''drop all buffered bytes'''
+        self._buf.clear()
+        self._start = 0
+
+    def _next_span(self, accept=None):
+        '''return (start, end) of the next valid frame and consume it, or None
+
+        If accept is given, complete frames whose (class, id) is not in it are
+        dropped without checksumming, provided the next preamble follows where
+        the header says the frame ends. Such a frame at the end of the buffer
+        waits for the two bytes after it.
+        '''
+        buf = self._buf
+        while True:
+            idx = buf.find(PREAMBLE, self._start)
+            if idx == -1:
+                # keep a trailing first preamble byte, it may be completed by the next read
+                keep = len(buf) - 1 if len(buf) > self._start and buf[-1] == PREAMBLE1 else len(buf)
+                self.discarded += keep - self._start
+                self._start = keep
+                return None
+            self.discarded += idx - self._start
+            self._start = idx
+            if len(buf) - idx < 6:
+                return None
+            length = buf[idx+4] | (buf[idx+5] << 8)
+            if length > self.max_payload:
+                self._start = idx + 1
+                self.discarded += 1
+                continue
+            end = idx + length + 8
+            if end > len(buf):
+                return None
+            if accept is not None and (buf[idx+2], buf[idx+3]) not in accept:
+                # the length field is only trusted once the next preamble confirms it
+                if end + 2 > len(buf):
+                    return None
+                if buf[end] == PREAMBLE1 and buf[end+1] == PREAMBLE2:
+                    self._start = end
+                    self.skipped += 1
+                    continue
+            with memoryview(buf) as view:
+                cs = ubx_checksum(view[idx+2:end-2])
+            if cs[0] != buf[end-2] or cs[1] != buf[end-1]:
+                self._start = idx + 1
+                self.discarded += 1
+                continue
+            self._start = end
+            if accept is not None and (buf[idx+2], buf[idx+3]) not in accept:
+                self.skipped += 1
+                continue
+            return (idx, end)
+
+    def pop_frame(self, accept=None):
+        '''return the next complete frame as bytes, or None if more data is needed'''
+        span = self._next_span(accept)
+        if span is None:
+            return None
+        return bytes(self._buf[span[0]:span[1]])
+
+    def frames(self, accept=None):
+        '''yield memoryviews of all complete frames currently buffered
+
+        Each view is only valid until the generator is resumed.
+        '''
+        while True:
+            span = self._next_span(accept)
+            if span is None:
+                return
+            view = memoryview(self._buf)[span[0]:span[1]]
+            try:
+                yield view
+            finally:
+                view.release()
 
 
 class UBlox:
@@ -680,6 +879,9 @@ class UBlox:
             import serial
             self.dev = serial.Serial(self.serial_device, baudrate=self.baudrate,
                                      dsrdtr=False, rtscts=False, xonxoff=False, timeout=timeout)
+        self.framer = UBloxFramer()
+        self.subscribers = {}
+        self.accept = set(SPECIAL_HANDLING_TYPES)
         self.logfile = None
         self.log = None
         self.preferred_dynamic_model = None
@@ -757,6 +959,25 @@ class UBlox:
                 return ''
         return self.dev.read(n)
 
+    def pending_bytes(self):
+        '''return the number of received bytes waiting in the serial driver'''
+        if hasattr(self.dev, 'in_waiting'):
+            return self.dev.in_waiting
+        return 0
+
+    def backlog(self):
+        '''return the number of received bytes not yet turned into messages'''
+        return self.pending_bytes() + len(self.framer)
+
+    def read_block(self):
+        '''read whatever is available, up to READ_BLOCK_SIZE bytes, blocking for at least one byte'''
+        if self.use_sendrecv:
+            return self.read(READ_BLOCK_SIZE)
+        if hasattr(self.dev, 'in_waiting'):
+            n = self.dev.in_waiting
+            return self.dev.read(min(max(n, 1), READ_BLOCK_SIZE))
+        return self.dev.read(READ_BLOCK_SIZE)
+
     def send_nmea(self, msg):
         if not self.read_only:
             s = msg + "*%02X" % self.nmea_checksum(msg)
@@ -777,11 +998,13 @@ class UBlox:
         '''seek to the given percentage of a file'''
         self.dev.seek(0, 2)
         filesize = self.dev.tell()
-        self.dev.seek(pct*0.01*filesize)
+        self.dev.seek(int(pct*0.01*filesize))
+        self.framer.reset()
 
     def special_handling(self, msg):
         '''handle automatic configuration changes'''
-        if msg.name() == 'CFG_NAV5':
+        type = msg.msg_type()
+        if type == (CLASS_CFG, MSG_CFG_NAV5):
             msg.unpack()
             sendit = False
             pollit = False
@@ -799,7 +1022,7 @@ class UBlox:
                 self.send(msg)
                 if pollit:
                     self.configure_poll(CLASS_CFG, MSG_CFG_NAV5)
-        if msg.name() == 'CFG_NAVX5' and self.preferred_usePPP is not None:
+        elif type == (CLASS_CFG, MSG_CFG_NAVX5) and self.preferred_usePPP is not None:
             msg.unpack()
             if msg.usePPP != self.preferred_usePPP:
                 msg.usePPP = self.preferred_usePPP
@@ -809,24 +1032,81 @@ class UBlox:
                 self.configure_poll(CLASS_CFG, MSG_CFG_NAVX5)
 
 
+    def subscribe(self, msg_class, msg_id, callback):
+        '''call callback(msg) for every received message of the given type from process_messages()'''
+        self.subscribers.setdefault((msg_class, msg_id), []).append(callback)
+        self.accept.add((msg_class, msg_id))
+
+    def unsubscribe(self, msg_class, msg_id, callback=None):
+        '''remove one callback, or all callbacks, for a message type'''
+        type = (msg_class, msg_id)
+        callbacks = self.subscribers.get(type, [])
+        if callback is None:
+            del callbacks[:]
+        elif callback in callbacks:
+            callbacks.remove(callback)
+        if not callbacks:
+            self.subscribers.pop(type, None)
+            if type not in SPECIAL_HANDLING_TYPES:
+                self.accept.discard(type)
+
+    def process_messages(self, ignore_eof=False):
+        '''read available bytes and dispatch every complete subscribed message
+
+        Frames of other types are dropped by the framer straight after the
+        header, and subscribers get messages whose fields are decoded on
+        first access. Returns the number of messages dispatched, or None on EOF.
+        '''
+        b = self.read_block()
+        if not b:
+            if ignore_eof:
+                time.sleep(0.01)
+                return 0
+            return None
+        if self.log is not None:
+            self.log.write(b)
+            self.log.flush()
+        self.framer.feed(b)
+
+        received = time.monotonic()
+        count = 0
+        while True:
+            frame = self.framer.pop_frame(self.accept)
+            if frame is None:
+                return count
+            msg = UBloxMessage()
+            msg._buf = frame
+            msg._valid_cache = (frame, True)
+            msg._received = received
+            type = msg.msg_type()
+            if type in SPECIAL_HANDLING_TYPES:
+                self.special_handling(msg)
+            for callback in self.subscribers.get(type, ()):
+                callback(msg)
+            count += 1
+
     def receive_message(self, ignore_eof=False):
         '''blocking receive of one ublox message'''
-        msg = UBloxMessage()
         while True:
-            n = msg.needed_bytes()
-            b = self.read(n)
+            frame = self.framer.pop_frame()
+            if frame is not None:
+                msg = UBloxMessage()
+                msg._buf = frame
+                # the framer has already verified the checksum
+                msg._valid_cache = (frame, True)
+                msg._received = time.monotonic()
+                self.special_handling(msg)
+                return msg
+            b = self.read_block()
             if not b:
                 if ignore_eof:
                     time.sleep(0.01)
                     continue
                 return None
-            msg.add(b)
             if self.log is not None:
                 self.log.write(b)
                 self.log.flush()
-            if msg.valid():
-                self.special_handling(msg)
-                return msg
+            self.framer.feed(b)
 
     def receive_message_noerror(self, ignore_eof=False):
         '''blocking receive of one ublox message, ignoring errors'''
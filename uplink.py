@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import logging
+from struct import *
+from loraframe import MAX_PACKET_SIZE
+
+# Messages the ground station sends back to the payload. Several of them
+# share one uplink transmission, which like a downlink frame carries at most
+# MAX_UPLINK_SIZE bytes on air after the address prefix.
+
+MAX_UPLINK_SIZE = MAX_PACKET_SIZE
+
+ACK_RECORD = 0xac # id (2 bytes), one transmission per record
+ACK_FRAME = 0xad # count, ids (2 bytes each) of every record in a received frame
+NACK_RANGES = 0xae # transfer id, total size, limit, count, (offset, length) of the missing parts of a chunked file below limit
+FEC_DONE = 0xaf # transfer id of an erasure coded image the ground station has decoded
+RATE_ACK = 0xb0 # air rate the ground station switches to after this transmission
+LINK_REPORT = 0xb1 # percentage of frames the ground station could not parse
+NACK_HEADER = Struct('>BHHB')
+NACK_RANGE = Struct('>HH')
+
+def encodeFrameAck(ids):
+    return bytes([ACK_FRAME, len(ids)]) + b''.join(pack('>H', id) for id in ids)
+
+def encodeNack(transferId, totalSize, limit, missing):
+    return bytes([NACK_RANGES]) + NACK_HEADER.pack(transferId, totalSize, limit, len(missing)) + b''.join(NACK_RANGE.pack(*r) for r in missing)
+
+def encodeUplink(ids=(), recordAcks=False, fecDone=None, linkReport=None, rateAck=None, nack=None):
+    '''one uplink transmission, at most MAX_UPLINK_SIZE bytes
+
+    The fixed size messages go first. nack, if given, is called with the
+    number of ranges that still fit and returns (transfer id, total size,
+    limit, missing)
+    or None.
+    '''
+    out = bytearray()
+    if recordAcks:
+        for id in ids:
+            out.extend(bytes([ACK_RECORD]) + pack('>H', id))
+    elif ids:
+        out.extend(encodeFrameAck(ids))
+    if fecDone is not None:
+        out.extend(bytes([FEC_DONE, fecDone]))
+    if linkReport is not None:
+        out.extend(bytes([LINK_REPORT, linkReport]))
+    if rateAck is not None:
+        out.extend(bytes([RATE_ACK, rateAck]))
+    if nack is not None:
+        maxRanges = (MAX_UPLINK_SIZE - len(out) - 1 - NACK_HEADER.size) // NACK_RANGE.size
+        ranges = nack(maxRanges) if maxRanges > 0 else None
+        if ranges is not None:
+            out.extend(encodeNack(*ranges))
+    return bytes(out)
+
+def parseUplink(data):
+    # returns ([(message type, value)], bytes consumed), an incomplete message is left in data
+    messages = []
+    i = 0
+    while i < len(data):
+        kind = data[i]
+        if kind == ACK_RECORD:
+            if i + 3 > len(data):
+                break
+            messages.append((ACK_RECORD, [(data[i+1] << 8) | data[i+2]]))
+            i += 3
+        elif kind == ACK_FRAME:
+            if i + 2 > len(data) or i + 2 + 2 * data[i+1] > len(data):
+                break
+            count = data[i+1]
+            messages.append((ACK_FRAME, unpack_from('>%dH' % count, data, i + 2)))
+            i += 2 + 2 * count
+        elif kind == NACK_RANGES:
+            if i + 1 + NACK_HEADER.size > len(data):
+                break
+            (transferId, totalSize, limit, count) = NACK_HEADER.unpack_from(data, i + 1)
+            end = i + 1 + NACK_HEADER.size + count * NACK_RANGE.size
+            if end > len(data):
+                break
+            missing = [NACK_RANGE.unpack_from(data, i + 1 + NACK_HEADER.size + n * NACK_RANGE.size) for n in range(count)]
+            messages.append((NACK_RANGES, (transferId, totalSize, limit, missing)))
+            i = end
+        elif kind in (FEC_DONE, RATE_ACK, LINK_REPORT):
+            if i + 2 > len(data):
+                break
+            messages.append((kind, data[i+1]))
+            i += 2
+        else:
+            logging.error("Unknown uplink message 0x%02x" % kind)
+            i += 1
+    return (messages, i)
+